@@ -0,0 +1,147 @@
+import weakref
+import hashlib
+import threading
+import numpy
+from nilearn.maskers import NiftiMasker
+from nilearn.maskers import NiftiLabelsMasker
+from nilearn import image
+from nilearn import datasets
+import cache
+
+FETCHERS = {'harvard_oxford' : datasets.fetch_atlas_harvard_oxford,
+            'juelich' : datasets.fetch_atlas_juelich}
+
+MAX_MASKERS = 32
+
+_lock = threading.RLock()
+_atlases = {}
+_resampled_labels = cache.LRUCache(MAX_MASKERS)
+_maskers = cache.LRUCache(MAX_MASKERS)
+_parcelizers = cache.LRUCache(MAX_MASKERS)
+_spatial_indices = cache.LRUCache(MAX_MASKERS)
+_image_keys = weakref.WeakKeyDictionary()
+
+
+def image_key(img):
+    # hashing the data is done once per image object
+    key = _image_keys.get(img)
+    if key is None:
+        data = numpy.ascontiguousarray(numpy.asanyarray(img.dataobj))
+        key = cache.make_key(img.affine.tobytes(), img.shape, hashlib.md5(data.tobytes()).hexdigest())
+        _image_keys[img] = key
+    return key
+
+
+def grid_key(affine, shape):
+    return cache.make_key(numpy.asarray(affine).tobytes(), tuple(shape[:3]))
+
+
+def get_atlas(name='cort-maxprob-thr25-2mm', family='harvard_oxford'):
+    with _lock:
+        if (family, name) not in _atlases:
+            _atlases[(family, name)] = FETCHERS[family](name)
+        return _atlases[(family, name)]
+
+
+def get_resampled_labels(name, affine, shape, family='harvard_oxford'):
+    key = (family, name, grid_key(affine, shape))
+    with _lock:
+        labels_img = _resampled_labels.get(key)
+        if labels_img is None:
+            labels_img = image.resample_img(get_atlas(name, family).filename, target_affine=affine,
+                target_shape=shape[:3], interpolation='nearest')
+            _resampled_labels.set(key, labels_img)
+        return labels_img
+
+
+def get_masker(mask_img):
+    if mask_img is None:
+        return None
+    key = image_key(mask_img)
+    with _lock:
+        masker = _maskers.get(key)
+        if masker is None:
+            masker = NiftiMasker(mask_img=mask_img, standardize=True, mask_strategy='epi')
+            _maskers.set(key, masker)
+    # fitting changes the masker, so every caller gets its own unfitted one on the shared parameters
+    return type(masker)(**masker.get_params())
+
+
+def get_parcelizer(name, mask_img, family='harvard_oxford'):
+    if mask_img is None:
+        return None
+    key = (family, name, image_key(mask_img))
+    with _lock:
+        parcelizer = _parcelizers.get(key)
+        if parcelizer is None:
+            labels_img = get_resampled_labels(name, mask_img.affine, mask_img.shape, family)
+            parcelizer = NiftiLabelsMasker(labels_img=labels_img, standardize=True,
+                               memory='nilearn_cache', verbose=5, mask_img=mask_img)
+            _parcelizers.set(key, parcelizer)
+    return type(parcelizer)(**parcelizer.get_params())
+
+
+class SpatialIndex(object):
+
+    def __init__(self, indices, affine):
+        from scipy.spatial import cKDTree
+        x, y, z = indices
+        coordinates = numpy.array(image.coord_transform(x, y, z, affine))
+        self.coordinates, self.inverse = numpy.unique(coordinates, axis=1, return_inverse=True)
+        self.inverse = self.inverse.ravel()
+        # position in the indexed voxels of each entry of coordinates
+        self.order = numpy.argsort(self.inverse, kind='stable')
+        self.tree = cKDTree(self.coordinates.T)
+
+    def query(self, position, radius=10):
+        return self.query_many([position], radius)[0]
+
+    def query_many(self, positions, radius=10):
+        positions = numpy.atleast_2d(numpy.asarray(positions, dtype=numpy.float64))
+        results = []
+        for position, idx in zip(positions, self.tree.query_ball_point(positions, radius)):
+            idx = numpy.sort(numpy.asarray(idx, dtype=int))
+            distances = numpy.linalg.norm(self.coordinates[:, idx].T - position, axis=1)
+            inside = distances < radius
+            idx, distances = idx[inside], distances[inside]
+            results += [(self.coordinates[:, idx], idx, distances)]
+        return results
+
+    def query_voxels(self, radius=10):
+        # sphere around every indexed voxel, as sorted positions in the indices the index was built from
+        results = self.query_many(self.coordinates.T[self.inverse], radius)
+        return [numpy.sort(self.order[idx]) for coordinates, idx, distances in results]
+
+
+def get_spatial_index(indices, affine):
+    digest = hashlib.md5()
+    for axis in indices:
+        digest.update(numpy.ascontiguousarray(axis).tobytes())
+    key = cache.make_key(numpy.asarray(affine).tobytes(), digest.hexdigest())
+    with _lock:
+        spatial_index = _spatial_indices.get(key)
+        if spatial_index is None:
+            spatial_index = SpatialIndex(indices, affine)
+            _spatial_indices.set(key, spatial_index)
+        return spatial_index
+
+
+def get_mask_spatial_index(mask_img):
+    # keyed on the memoized image key, so the voxels of the mask are not hashed again
+    key = ('mask', image_key(mask_img))
+    with _lock:
+        spatial_index = _spatial_indices.get(key)
+        if spatial_index is None:
+            indices = numpy.where(numpy.asanyarray(mask_img.dataobj) > 0)
+            spatial_index = SpatialIndex(indices, mask_img.affine)
+            _spatial_indices.set(key, spatial_index)
+        return spatial_index
+
+
+def clear():
+    with _lock:
+        _atlases.clear()
+        _resampled_labels.clear()
+        _maskers.clear()
+        _parcelizers.clear()
+        _spatial_indices.clear()
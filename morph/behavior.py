@@ -0,0 +1,322 @@
+import os
+import re
+import csv
+import json
+import warnings
+import concurrent.futures
+import numpy
+
+LABEL_COLUMNS = ['run', 'trial', 'global time', 'run time', 'morph level', 'couple', 'response', 'response time']
+STORE_COLUMNS = {'subject' : numpy.int16,
+                 'run' : numpy.int8,
+                 'trial' : numpy.int16,
+                 'global time' : numpy.int64,
+                 'run time' : numpy.int64,
+                 'morph level' : numpy.int8,
+                 'couple' : numpy.int8,
+                 'response' : numpy.int8,
+                 'response time' : numpy.float32,
+                 'excluded' : numpy.bool_}
+
+
+def iter_trials(lines):
+    run = 0
+    trial = None
+    pending = []
+    global_t_start = None
+    morph_level = None
+    couple = None
+    t_start = None
+
+    def flush():
+        if len(pending) > 0 and global_t_start is None:
+            raise ValueError('No Synchro_IRM line found in run %d' %run)
+        for record in pending:
+            record['run time'] = record['global time'] - global_t_start
+            yield record
+        del pending[:]
+
+    def close():
+        if trial is not None:
+            pending.append({'run' : run,
+                            'trial' : trial['trial'],
+                            'global time' : t_start,
+                            'run time' : None,
+                            'morph level' : morph_level,
+                            'couple' : couple,
+                            'response' : trial['response'],
+                            'response time' : trial['response time']})
+
+    for line in lines:
+        if line.find('Debut_run ') > -1:
+            close()
+            yield from flush()
+            run += 1
+            trial = None
+            global_t_start = None
+
+        if run == 0:
+            continue
+
+        if global_t_start is None and line.find('Synchro_IRM') > -1:
+            global_t_start = int(line.split(',')[0])
+
+        if line.find('MORPH') > -1:
+            close()
+            nb_item = 1 if trial is None else trial['trial'] + 1
+            trial = {'trial' : nb_item, 'response' : 0, 'response time' : None}
+
+        if trial is not None:
+            if line.find('morph_') > -1:
+                file_name = line.split(',')[3].split(' ')[1]
+                file_name = file_name.split("\\")[2]
+                morph_level = int(file_name.split('_')[1])
+                couple = int(file_name.split('_')[2].split('.')[0])
+                t_start = int(line.split(',')[3].split(' ')[2])
+
+            if line.find('bouton_1') > -1:
+                trial['response'] = 1
+                trial['response time'] = int(line.split(',')[3].split(' ')[1]) + 500
+
+        if global_t_start is not None:
+            yield from flush()
+
+    close()
+    yield from flush()
+
+
+def parse_labels(raw_csv_file, output_file):
+    output_file = str(output_file)
+    tmp_file = output_file + '.tmp'
+    with open(raw_csv_file) as f, open(tmp_file, 'w', newline='') as csvfile:
+        writer = csv.DictWriter(csvfile, fieldnames=LABEL_COLUMNS)
+        writer.writeheader()
+        for record in iter_trials(f):
+            writer.writerow(record)
+    os.replace(tmp_file, output_file)
+    return output_file
+
+
+def convert_labels(input_folder='labels/raw', output_folder='labels', n_jobs=None):
+    files = sorted(os.listdir(input_folder))
+    inputs = [os.path.join(input_folder, file) for file in files]
+    outputs = [os.path.join(output_folder, file) for file in files]
+    with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+        return list(executor.map(parse_labels, inputs, outputs))
+
+
+def read_exclusion(filename):
+    if not os.path.exists(filename):
+        return numpy.zeros(0, dtype=int)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        return numpy.loadtxt(filename, ndmin=1).astype(int)
+
+
+def _column_filename(path, column):
+    return os.path.join(path, column.replace(' ', '_') + '.npy')
+
+
+class BehaviorStore(object):
+
+    def __init__(self, path='labels/store', labels_folder='labels', mmap_mode='r'):
+        self.path = path
+        self.labels_folder = labels_folder
+        self.mmap_mode = mmap_mode
+        if self.is_stale:
+            self.build()
+        self._load()
+
+    @property
+    def exclusion_folder(self):
+        return os.path.join(self.labels_folder, 'exclusion')
+
+    @property
+    def sources(self):
+        sources = {}
+        for file in os.listdir(self.labels_folder):
+            match = re.match(r'labels_(\d+)\.csv$', file)
+            if match is not None:
+                subject = int(match.group(1))
+                labels_file = os.path.join(self.labels_folder, file)
+                exclusion_file = os.path.join(self.exclusion_folder, 'couples_%d.csv' %subject)
+                sources[subject] = [labels_file, exclusion_file]
+        return dict(sorted(sources.items()))
+
+    def _get_signature(self):
+        signature = {}
+        for subject, files in self.sources.items():
+            signature[str(subject)] = [os.stat(f).st_mtime_ns if os.path.exists(f) else None for f in files]
+        return signature
+
+    @property
+    def is_stale(self):
+        meta_file = os.path.join(self.path, 'meta.json')
+        if not os.path.exists(meta_file):
+            return True
+        if not os.path.isdir(self.labels_folder):
+            return False
+        with open(meta_file) as f:
+            return json.load(f)['sources'] != self._get_signature()
+
+    def build(self):
+        columns = {column : [] for column in STORE_COLUMNS}
+        for subject, (labels_file, exclusion_file) in self.sources.items():
+            with open(labels_file, newline='') as f:
+                rows = list(csv.DictReader(f))
+            excluded = read_exclusion(exclusion_file)
+            for row in rows:
+                for column in LABEL_COLUMNS:
+                    if row[column] == '':
+                        columns[column] += [numpy.nan]
+                    else:
+                        columns[column] += [int(row[column])]
+                columns['excluded'] += [int(row['couple']) in excluded]
+            columns['subject'] += [subject] * len(rows)
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        for column, dtype in STORE_COLUMNS.items():
+            numpy.save(_column_filename(self.path, column), numpy.array(columns[column], dtype=dtype))
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'columns' : list(STORE_COLUMNS), 'sources' : self._get_signature()}, f)
+
+    def _load(self):
+        self.columns = {}
+        for column in STORE_COLUMNS:
+            self.columns[column] = numpy.load(_column_filename(self.path, column), mmap_mode=self.mmap_mode)
+        # rows are grouped by subject, so a subject is a contiguous slice
+        subjects = numpy.asarray(self.columns['subject'])
+        self.subjects, starts = numpy.unique(subjects, return_index=True)
+        stops = numpy.append(starts[1:], len(subjects))
+        self._slices = {int(s) : slice(a, b) for s, a, b in zip(self.subjects, starts, stops)}
+
+    def __len__(self):
+        return len(self.columns['subject'])
+
+    def __getitem__(self, column):
+        return self.columns[column]
+
+    def _get_rows(self, subject=None):
+        if subject is None:
+            return slice(0, len(self))
+        if numpy.isscalar(subject):
+            return self._slices.get(int(subject), slice(0, 0))
+        slices = [self._get_rows(s) for s in subject]
+        return numpy.concatenate([numpy.arange(i.start, i.stop) for i in slices] + [numpy.zeros(0, dtype=int)])
+
+    def query(self, subject=None, run=None, couple=None, morph_level=None, excluded=None, columns=None):
+        rows = self._get_rows(subject)
+        if columns is None:
+            columns = list(STORE_COLUMNS)
+        mask = None
+        for column, value in [('run', run), ('couple', couple), ('morph level', morph_level), ('excluded', excluded)]:
+            if value is not None:
+                selection = numpy.isin(self.columns[column][rows], value)
+                mask = selection if mask is None else mask & selection
+        result = {}
+        for column in columns:
+            result[column] = self.columns[column][rows]
+            if mask is not None:
+                result[column] = result[column][mask]
+        return result
+
+    def get_labels(self, subject, **filters):
+        import pandas
+        data = self.query(subject, columns=LABEL_COLUMNS, **filters)
+        return pandas.DataFrame({column : numpy.asarray(data[column]) for column in LABEL_COLUMNS})
+
+    def get_excluded_couples(self, subject):
+        data = self.query(subject, excluded=True, columns=['couple'])
+        return numpy.unique(data['couple']).astype(float)
+
+
+def sigmoid(x, L, x0, k, b):
+    return L / (1 + numpy.exp(-k*(x-x0))) + b
+
+
+def _group(columns, by):
+    codes = []
+    sizes = []
+    keys = []
+    for column in by:
+        values, inverse = numpy.unique(numpy.asarray(columns[column]), return_inverse=True)
+        keys += [values]
+        codes += [inverse.ravel()]
+        sizes += [len(values)]
+    if len(codes) == 0:
+        return {}, numpy.zeros(0, dtype=int)
+    flat = numpy.ravel_multi_index(codes, sizes)
+    groups, inverse = numpy.unique(flat, return_inverse=True)
+    result = {}
+    for column, values, index in zip(by, keys, numpy.unravel_index(groups, sizes)):
+        result[column] = values[index]
+    return result, inverse.ravel()
+
+
+def aggregate(columns, by=('subject', 'run', 'couple', 'morph level'), values=('response', 'response time')):
+    if isinstance(columns, BehaviorStore):
+        columns = columns.query()
+    result, inverse = _group(columns, by)
+    nb_groups = len(result[by[0]]) if len(by) > 0 else 0
+    result['count'] = numpy.bincount(inverse, minlength=nb_groups)
+
+    for column in values:
+        data = numpy.asarray(columns[column], dtype=numpy.float64)
+        valid = ~numpy.isnan(data)
+        data = numpy.where(valid, data, 0)
+        nb_valid = numpy.bincount(inverse, weights=valid, minlength=nb_groups)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            mean = numpy.bincount(inverse, weights=data, minlength=nb_groups) / nb_valid
+            deviation = numpy.where(valid, data - mean[inverse], 0)
+            std = numpy.sqrt(numpy.bincount(inverse, weights=deviation**2, minlength=nb_groups) / nb_valid)
+            sem = std / numpy.sqrt(result['count'])
+        result[column + ' mean'] = numpy.nan_to_num(mean)
+        result[column + ' sem'] = numpy.nan_to_num(sem)
+    return result
+
+
+def get_mean_responses(x, y, z):
+    data = aggregate({'morph level' : x, 'response' : y, 'response time' : z}, by=('morph level',))
+    results = {}
+    results['response'] = {'mean' : data['response mean'], 'std' : data['response sem']}
+    results['response_time'] = {'mean' : data['response time mean'], 'std' : data['response time sem']}
+    return results
+
+
+def get_couple_curves(store, subjects=None, run=None):
+    data = aggregate(store.query(subjects, run=run), by=('subject', 'couple', 'morph level'), values=('response',))
+    curves, inverse = _group(data, ('subject', 'couple'))
+    levels = numpy.unique(data['morph level'])
+    counts = numpy.bincount(inverse, minlength=len(curves['subject']))
+    responses = numpy.full((len(curves['subject']), len(levels)), numpy.nan)
+    responses[inverse, numpy.searchsorted(levels, data['morph level'])] = data['response mean']
+    curves['response'] = responses
+    curves['complete'] = counts == len(levels)
+    return levels, curves
+
+
+def compute_exclusions(store, subjects=None, run=None, threshold=0.25, output_folder=None):
+    from scipy.optimize import curve_fit
+
+    levels, curves = get_couple_curves(store, subjects, run)
+    xdata = numpy.linspace(5, 95, 10)
+    results = {int(subject) : [] for subject in numpy.unique(curves['subject'])}
+
+    for subject, couple, ydata, complete in zip(curves['subject'], curves['couple'], curves['response'], curves['complete']):
+        popt = [0, 0, 0, 0]
+        if complete and len(ydata) == len(xdata):
+            p0 = [max(ydata), numpy.median(xdata), 1, min(ydata)]
+            try:
+                popt, pcov = curve_fit(sigmoid, xdata, ydata, p0, maxfev=5000)
+            except Exception:
+                popt = [0, 0, 0, 0]
+        y_min = sigmoid(5, *popt)
+        y_max = sigmoid(95, *popt)
+        if not(popt[1] < 100 and (y_max - y_min) > threshold):
+            results[int(subject)] += [int(couple)]
+
+    if output_folder is not None:
+        for subject, to_exclude in results.items():
+            numpy.savetxt(os.path.join(output_folder, 'couples_%d.csv' %subject), to_exclude)
+    return results
@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy
+import nibabel
+import pandas
+import profiling
+from collections.abc import MutableMapping
+
+REPETITION_TIME = 2.39951
+MORPH_LEVELS = numpy.arange(5, 105, 10)
+CONFOUND_COLUMNS = ['a_comp_cor_%02d' %i for i in range(6)] + ['cosine%02d' %i for i in range(6)] + \
+                   ['trans_x', 'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
+_MISSING = object()
+STAGES = ['parse_labels', 'convert_to_bids', 'indexing', 'cleaned', 'export', 'connectivity', 'glm']
+DCM2NIIX_STUB = '''#!%s
+import os, sys
+args = sys.argv[1:]
+name = args[args.index('-f') + 1]
+output = args[args.index('-o') + 1]
+for extension in ['.nii.gz', '.json']:
+    open(os.path.join(output, name + extension), 'w').close()
+''' %sys.executable
+
+
+class Fixture(object):
+
+    def __init__(self, root, nb_subjects, nb_runs=4, shape=(12, 14, 12), nb_volumes=80, nb_regions=8, seed=0):
+        self.root = root
+        self.nb_subjects = nb_subjects
+        self.nb_runs = nb_runs
+        self.shape = tuple(shape)
+        self.nb_volumes = nb_volumes
+        self.nb_regions = nb_regions
+        self.rng = numpy.random.default_rng(seed)
+        self.affine = numpy.diag([4., 4., 4., 1.])
+        self.affine[:3, 3] = -2 * numpy.array(self.shape)
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    @property
+    def subjects(self):
+        return list(range(1, self.nb_subjects + 1))
+
+    def make_atlas(self):
+        labels = numpy.zeros(self.shape, dtype=numpy.int16)
+        slabs = numpy.array_split(numpy.arange(1, self.shape[0] - 1), self.nb_regions)
+        for region, slab in enumerate(slabs):
+            labels[slab, 1:-1, 1:-1] = region + 1
+        filename = self.path('atlas.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(labels, self.affine), filename)
+        return filename
+
+    def make_run(self, subject, run):
+        sub_key = 'sub-%02d' %subject
+        name = '%s_task-morph_run-%d' %(sub_key, run)
+
+        func = self.path('bids', sub_key, 'func')
+        os.makedirs(func, exist_ok=True)
+        raw = nibabel.Nifti1Image(numpy.zeros(self.shape + (self.nb_volumes,), dtype=numpy.int16), self.affine)
+        raw.header.set_zooms((4., 4., 4., REPETITION_TIME))
+        nibabel.save(raw, os.path.join(func, name + '_bold.nii.gz'))
+
+        derivatives = self.path('derivatives', sub_key, 'func')
+        os.makedirs(derivatives, exist_ok=True)
+        data = self.rng.normal(100, 5, self.shape + (self.nb_volumes,)).astype(numpy.float32)
+        img = nibabel.Nifti1Image(data, self.affine)
+        img.header.set_zooms((4., 4., 4., REPETITION_TIME))
+        prefix = os.path.join(derivatives, name + '_space-MNI152NLin2009cAsym')
+        nibabel.save(img, prefix + '_desc-preproc_bold.nii.gz')
+        mask = numpy.zeros(self.shape, dtype=numpy.uint8)
+        mask[1:-1, 1:-1, 1:-1] = 1
+        nibabel.save(nibabel.Nifti1Image(mask, self.affine), prefix + '_desc-brain_mask.nii.gz')
+        confounds = pandas.DataFrame(self.rng.normal(size=(self.nb_volumes, len(CONFOUND_COLUMNS))),
+                                     columns=CONFOUND_COLUMNS)
+        confounds.to_csv(os.path.join(derivatives, name + '_desc-confounds_timeseries.tsv'), sep='\t', index=False)
+
+    def make_cogent_log(self, subject):
+        # same layout as the Cogent 2000 logs in labels/raw, one trial every ~5 s
+        lines = ['Cog2000 log file,,,,,,,', '2,[2],:,COGENT START,,,,']
+        t = 5000
+        duration = 1000 * REPETITION_TIME * (self.nb_volumes - 2)
+        for run in range(1, self.nb_runs + 1):
+            lines += ['%d,[0],:,Debut_run %d : run %d,,,,' %(t, run, run)]
+            t += 20000
+            t_start = t
+            lines += ['%d,[0],:,Synchro_IRM,,,,' %t]
+            trial = 0
+            while t + 6000 - t_start < duration:
+                t += int(self.rng.integers(4000, 6000))
+                level = MORPH_LEVELS[trial % len(MORPH_LEVELS)]
+                couple = int(self.rng.integers(1, 11))
+                lines += ['%d,[0],:,image Morphs_IRM\\MORPH_%d_PERCENT_FAMILIARITY\\morph_%d_%d.BMP %d,,,,'
+                          %(t, level, level, couple, t)]
+                lines += ['%d,[500],:,image croix %d,,,,' %(t + 500, t + 500)]
+                if self.rng.random() < level / 100:
+                    lines += ['%d,[0],:,bouton_1 %d,,,,' %(t + 1500, int(self.rng.integers(200, 1500)))]
+                trial += 1
+            t += 6000
+            lines += ['%d,[0],:,Fin_run %d : run %d,,,,' %(t, run, run)]
+            t += 60000
+        lines += ['%d,[0],:,COGENT STOP,,,,' %t]
+        filename = self.path('labels', 'raw', 'labels_%d.csv' %subject)
+        with open(filename, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        return filename
+
+    def make_raw_subject(self, subject):
+        path = self.path('raw_data', 'Sujet %d' %subject)
+        for run in range(1, self.nb_runs + 1):
+            run_path = os.path.join(path, 'run %d' %run)
+            os.makedirs(run_path, exist_ok=True)
+            with open(os.path.join(run_path, 'scan.REC'), 'wb') as f:
+                f.write(self.rng.bytes(numpy.prod(self.shape) * self.nb_volumes * 2))
+            with open(os.path.join(run_path, 'scan.PAR'), 'w') as f:
+                f.write('# synthetic PAR header\n')
+        anat = os.path.join(path, 'anat')
+        os.makedirs(anat, exist_ok=True)
+        for count in range(3):
+            with open(os.path.join(anat, 'im%d.dcm' %count), 'wb') as f:
+                f.write(self.rng.bytes(numpy.prod(self.shape) * 2))
+        with open(os.path.join(path, 'notes.xlsx'), 'w') as f:
+            f.write('x')
+
+    def build(self):
+        for folder in ['bids', 'derivatives', 'raw_data', 'bin', os.path.join('labels', 'raw')]:
+            os.makedirs(self.path(folder), exist_ok=True)
+        self.make_atlas()
+
+        with open(self.path('bids', 'dataset_description.json'), 'w') as f:
+            json.dump({'BIDSVersion' : '1.8.0', 'Name' : 'morph benchmark'}, f)
+        with open(self.path('bids', 'participants.tsv'), 'w') as f:
+            f.write('key\n' + ''.join('sub-%02d\n' %subject for subject in self.subjects))
+        with open(self.path('database.csv'), 'w') as f:
+            f.write('Name\tCondition\n' + ''.join('Sujet %d\tSain\n' %subject for subject in self.subjects))
+
+        for subject in self.subjects:
+            for run in range(1, self.nb_runs + 1):
+                self.make_run(subject, run)
+            self.make_cogent_log(subject)
+            self.make_raw_subject(subject)
+
+        stub = self.path('bin', 'dcm2niix')
+        with open(stub, 'w') as f:
+            f.write(DCM2NIIX_STUB)
+        os.chmod(stub, 0o755)
+        return self
+
+
+class Benchmark(object):
+
+    def __init__(self, fixture, n_jobs=1, trace_memory=False):
+        self.fixture = fixture
+        self.n_jobs = n_jobs
+        self.trace_memory = trace_memory
+        self._database = None
+
+        self._saved = []
+
+        import atlases
+        import mri
+        from sklearn.utils import Bunch
+        atlas = Bunch(filename=fixture.path('atlas.nii.gz'), maps=fixture.path('atlas.nii.gz'),
+                      labels=['Background'] + ['region %d' %i for i in range(1, fixture.nb_regions + 1)])
+        atlases.clear()
+        self._patch(atlases.FETCHERS, 'benchmark', lambda name: atlas)
+        self._patch(mri, 'ATLAS_FAMILY', 'benchmark')
+        self._patch(mri, 'CACHE_PATH', fixture.path('cache'))
+        self._patch(mri, 'TIMESERIES_PATH', fixture.path('timeseries'))
+        self._patch(mri, 'MIRROR_PATH', fixture.path('mirror'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.restore()
+
+    def _patch(self, target, name, value):
+        # module globals and dict entries pointed at the fixture, put back by restore
+        if isinstance(target, MutableMapping):
+            self._saved += [(target, name, target.get(name, _MISSING))]
+            target[name] = value
+        else:
+            self._saved += [(target, name, getattr(target, name))]
+            setattr(target, name, value)
+
+    def restore(self):
+        import atlases
+        for target, name, value in reversed(self._saved):
+            if not isinstance(target, MutableMapping):
+                setattr(target, name, value)
+            elif value is _MISSING:
+                target.pop(name, None)
+            else:
+                target[name] = value
+        self._saved = []
+        self._database = None
+        # drop the atlases and maskers built from the fixture
+        atlases.clear()
+
+    @property
+    def database(self):
+        if self._database is None:
+            from bids_utils import BIDSDatabase
+            self._database = BIDSDatabase(self.fixture.path('bids'), self.fixture.path('derivatives'),
+                                          mri_cache_size=2 * self.n_jobs)
+        return self._database
+
+    def _runs(self):
+        for subject in self.fixture.subjects:
+            for run in self.database.get_func(subject, lazy=True):
+                yield run
+
+    def parse_labels(self):
+        from behavior import parse_labels
+        for subject in self.fixture.subjects:
+            parse_labels(self.fixture.path('labels', 'raw', 'labels_%d.csv' %subject),
+                         self.fixture.path('labels', 'labels_%d.csv' %subject))
+        return self.fixture.nb_subjects
+
+    def convert_to_bids(self):
+        import bids_utils
+        self._patch(bids_utils, 'DATA_PATH', self.fixture.path('raw_data'))
+        self._patch(bids_utils, 'BIDS_PATH', self.fixture.path('converted'))
+        self._patch(os.environ, 'PATH', self.fixture.path('bin') + os.pathsep + os.environ['PATH'])
+        converters = {'anat' : ['anat', 'T1w', bids_utils.RECtoNIFTIConverter],
+                      'fmri' : ['func', 'task-rest_bold', bids_utils.RECtoNIFTIConverter]}
+        reader = bids_utils.DataBaseReader(self.fixture.path('database.csv'), converters)
+        reader.convert_to_bids('morph benchmark', n_jobs=self.n_jobs,
+                               journal_path=self.fixture.path('conversion.json'))
+        return self.fixture.nb_subjects
+
+    def indexing(self):
+        from bids_utils import BIDSDatabase
+        database = BIDSDatabase(self.fixture.path('bids'), self.fixture.path('derivatives'), index=True)
+        return sum(len(database.get_func(subject, lazy=True)) for subject in self.fixture.subjects)
+
+    def cleaned(self):
+        count = 0
+        for run in self._runs():
+            run.cleaned
+            count += 1
+        return count
+
+    def export(self):
+        count = 0
+        for run in self._runs():
+            run.export(self.fixture.path('export', os.path.basename(run.filename).split('.')[0]))
+            count += 1
+        return count
+
+    def connectivity(self):
+        self.database.get_connectivity(self.fixture.subjects, range(self.fixture.nb_runs), n_jobs=self.n_jobs)
+        return self.fixture.nb_subjects * self.fixture.nb_runs
+
+    def glm(self):
+        from behavior import BehaviorStore
+        from glm import FirstLevel
+        store = BehaviorStore(self.fixture.path('labels', 'store'), self.fixture.path('labels'))
+        first_level = FirstLevel(self.database, store, output_path=self.fixture.path('glm'),
+                                 runs=range(self.fixture.nb_runs))
+        first_level.fit(self.fixture.subjects, n_jobs=self.n_jobs)
+        return self.fixture.nb_subjects
+
+    def run_stage(self, stage):
+        if stage == 'export':
+            os.makedirs(self.fixture.path('export'), exist_ok=True)
+        if self.trace_memory:
+            tracemalloc.start()
+        t_start = time.perf_counter()
+        with profiling.span(stage, nb_subjects=self.fixture.nb_subjects):
+            nb_items = getattr(self, stage)()
+        duration = time.perf_counter() - t_start
+        result = {'time' : duration,
+                  'items' : nb_items,
+                  'throughput' : nb_items / duration,
+                  'peak_rss' : profiling.peak_rss()}
+        if self.trace_memory:
+            result['peak_allocated'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        return result
+
+
+def run(sizes=(1, 10, 100), stages=STAGES, root=None, n_jobs=1, trace_memory=False, keep=False, **kwargs):
+    results = {}
+    for nb_subjects in sizes:
+        path = tempfile.mkdtemp(prefix='morph_benchmark_', dir=root)
+        try:
+            t_start = time.perf_counter()
+            fixture = Fixture(path, nb_subjects, **kwargs).build()
+            print('%d subjects: fixtures built in %.1fs' %(nb_subjects, time.perf_counter() - t_start))
+            with Benchmark(fixture, n_jobs, trace_memory) as benchmark:
+                for stage in stages:
+                    result = benchmark.run_stage(stage)
+                    results['%s/%d' %(stage, nb_subjects)] = result
+                    print('%-16s %4d subjects  %8.2fs  %8.2f items/s  %7.1f MB' %(stage, nb_subjects,
+                        result['time'], result['throughput'], (result['peak_rss'] or 0) / 1024**2))
+        finally:
+            if not keep:
+                shutil.rmtree(path, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, tolerance=0.25):
+    # a stage regresses when it is slower than the baseline by more than the tolerance
+    regressions = []
+    for key, result in sorted(results.items()):
+        if key not in baseline:
+            continue
+        ratio = result['time'] / baseline[key]['time']
+        status = 'slower' if ratio > 1 + tolerance else ('faster' if ratio < 1 - tolerance else 'same')
+        print('%-24s %8.2fs  baseline %8.2fs  x%.2f  %s' %(key, result['time'], baseline[key]['time'], ratio, status))
+        if status == 'slower':
+            regressions += [key]
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the morph pipeline on synthetic data')
+    parser.add_argument('--subjects', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES)
+    parser.add_argument('--runs', type=int, default=4)
+    parser.add_argument('--shape', type=int, nargs=3, default=[12, 14, 12])
+    parser.add_argument('--volumes', type=int, default=80)
+    parser.add_argument('--n-jobs', type=int, default=1)
+    parser.add_argument('--root', default=None, help='where to generate the fixtures')
+    parser.add_argument('--keep', action='store_true', help='keep the generated fixtures')
+    parser.add_argument('--trace-memory', action='store_true', help='record peak allocations with tracemalloc')
+    parser.add_argument('--output', default=None, help='write the results to this json file')
+    parser.add_argument('--baseline', default=None, help='json file from a previous --output to compare to')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    results = run(args.subjects, args.stages, args.root, args.n_jobs, args.trace_memory, args.keep,
+                  nb_runs=args.runs, shape=args.shape, nb_volumes=args.volumes)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'platform' : platform.platform(), 'python' : platform.python_version(),
+                       'cpu_count' : os.cpu_count(), 'results' : results}, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.tolerance)
+        if len(regressions) > 0:
+            print('Regressions:', ', '.join(regressions))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,11 +5,24 @@ import shutil
 import nibabel
 import time
 import json
+import warnings
+import subprocess
+import collections
+import collections.abc
+import concurrent.futures
 import mri
+import cache
+import indexing
+import scheduler
+import transfer
+import profiling
+import decoding
 
 GLOBAL_PATH = os.path.abspath('.')
 DATA_PATH = os.path.join(GLOBAL_PATH, "raw_data")
 BIDS_PATH = os.path.join(GLOBAL_PATH, "bids")
+JOURNAL_PATH = os.path.join(GLOBAL_PATH, "conversion.json")
+MRI_CACHE_SIZE = 4
 
 
 def gvalue(csv_row, keys):
@@ -73,6 +86,27 @@ class DataConverter(object):
 
         self._new_files = []
         self._old_files = []
+        self._logs = []
+        self.checksums = None
+
+    def _run(self, command):
+        with profiling.span(os.path.basename(command[0]), input=command[-1]):
+            process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        self._logs += [{'command' : ' '.join(command),
+                        'returncode' : process.returncode,
+                        'stdout' : process.stdout,
+                        'stderr' : process.stderr}]
+        if process.returncode != 0:
+            raise RuntimeError('%s failed with code %d' %(command[0], process.returncode))
+        return process
+
+    def _remove(self, filename):
+        # the raw data are only removed once they are known to match the verified copy
+        if self.checksums is not None:
+            expected = self.checksums.get(os.path.abspath(filename))
+            if expected is None or not transfer.verify(filename, expected):
+                raise RuntimeError('%s does not match its checksum, not removed' %filename)
+        os.remove(filename)
 
     def _filter_files(self, extension):
         self.all_files = [i for i in self.all_files if os.path.splitext(i)[1].lower() == extension]
@@ -104,6 +138,10 @@ class DataConverter(object):
     def old_files(self):
         return self._old_files
 
+    @property
+    def logs(self):
+        return self._logs
+
 
 
 class Subject(object):
@@ -132,18 +170,18 @@ class RECtoNIFTIConverter(DataConverter):
         for file in self.all_files:
             name = os.path.basename(file)
             nifti_file = os.path.join(pattern + '_' + extension)
-            os.system('dcm2niix -b y -z y -i n -f "%s" -o "%s" "%s"' %(nifti_file, self.output_folder, file))
+            self._run(['dcm2niix', '-b', 'y', '-z', 'y', '-i', 'n', '-w', '1', '-f', nifti_file, '-o', self.output_folder, file])
             self._new_files += [os.path.join(self.output_folder, nifti_file + '.nii.gz')]
             self._old_files += [file]
 
     def _clean(self):
         for rec_file in self.old_files:
-            os.remove(rec_file)
+            self._remove(rec_file)
             file_no_extension = os.path.splitext(rec_file)[0]
             for ext in ['.par', '.PAR']:
                 par_file = file_no_extension + ext
                 if os.path.exists(par_file):
-                    os.remove(par_file)
+                    self._remove(par_file)
 
 class DICOMtoNIFTIConverter(DataConverter):
 
@@ -152,7 +190,7 @@ class DICOMtoNIFTIConverter(DataConverter):
 
     def convert(self, pattern, extension):
         nifti_file = os.path.join(pattern + '_' + extension)
-        os.system('dcm2niix -b y -z y -i n -f "%s" -o "%s" "%s"' %(nifti_file, self.output_folder, self.input_folder))
+        self._run(['dcm2niix', '-b', 'y', '-z', 'y', '-i', 'n', '-w', '1', '-f', nifti_file, '-o', self.output_folder, self.input_folder])
         self._new_files += [os.path.join(self.output_folder, nifti_file + '.nii.gz')]
         #self._old_files += [file]
 
@@ -160,7 +198,7 @@ class DICOMtoNIFTIConverter(DataConverter):
         for file in os.listdir(self.input_folder):
             file_no_extension, ext = os.path.splitext(file)
             if ext == '.dcm':
-                os.remove(os.path.join(self.input_folder, file))
+                self._remove(os.path.join(self.input_folder, file))
     
 
 class DataBaseReader(object):
@@ -224,123 +262,251 @@ extra_data/
         csv_writer.writeheader()
         csv_writer.writerows(participants_rows)
 
-    def convert_to_bids(self, name):
+    def _prepare_subject(self, count, journal, copy_mode='link', n_threads=4):
+        subject = self[count]
+        sub_key = 'sub-%02d' %(count + 1)
+        bids_folder = os.path.join(BIDS_PATH, sub_key)
+
+        if not os.path.exists(subject.data_path):
+            return []
+
+        copy_state = journal.get('%s/copy' %sub_key)
+        if copy_state is None and os.path.exists(bids_folder):
+            # folder copied before the journal existed, nothing to verify against
+            copy_state = {'state' : 'done'}
+            journal.set('%s/copy' %sub_key, **copy_state)
+        elif copy_state is None or copy_state['state'] != 'done':
+            t_start = time.time()
+            journal.set('%s/copy' %sub_key, state='running')
+            with profiling.span('copy', sub=sub_key):
+                files = transfer.copy_tree(subject.data_path, bids_folder, mode=copy_mode, n_threads=n_threads)
+            profiling.count('copied files', len(files), sub=sub_key)
+            copy_state = {'state' : 'done', 'files' : files, 'duration' : time.time() - t_start}
+            journal.set('%s/copy' %sub_key, **copy_state)
+
+        checksums = None
+        if 'files' in copy_state:
+            checksums = {os.path.abspath(os.path.join(bids_folder, file)) : value
+                         for file, value in copy_state['files'].items()}
+
+        subject.set_new_key(sub_key)
+        tasks = []
+
+        for run_id in range(1, 6):
+            folder = f'run {run_id}'
+            path = os.path.join(bids_folder, folder)
+            if os.path.isdir(path):
+                if len(os.listdir(path)) == 2:
+                    type_converter = self.converters['fmri'][2]
+                else:
+                    type_converter = DICOMtoNIFTIConverter
+                task_name = f'task-morph_run-{run_id}_bold'
+                target_folder = self.converters['fmri'][0]
+                tasks += [ConversionTask(sub_key, folder, path, type_converter, target_folder, task_name,
+                                         checksums)]
+
+        for folder in ['anat']:
+            path = os.path.join(bids_folder, folder)
+            if os.path.isdir(path):
+                if len(os.listdir(path)) == 2:
+                    type_converter = self.converters[folder][2]
+                else:
+                    type_converter = DICOMtoNIFTIConverter
+                task_name = self.converters[folder][1]
+                target_folder = self.converters[folder][0]
+                tasks += [ConversionTask(sub_key, folder, path, type_converter, target_folder, task_name,
+                                         checksums)]
+
+        return [task for task in tasks if journal.get(task.key, {}).get('state') != 'done']
+
+    def write_bids_scans(self, sub_key, journal):
+        bids_folder = os.path.join(BIDS_PATH, sub_key)
+        filename = os.path.join(bids_folder, '%s_scans.tsv' %(sub_key))
+        rows = []
+        if os.path.exists(filename):
+            with open(filename, newline='') as fd:
+                rows = list(csv.DictReader(fd, dialect=self.dialect))
+
+        for folder in [f'run {run_id}' for run_id in range(1, 6)] + ['anat']:
+            entry = journal.get('%s/%s' %(sub_key, folder))
+            if entry is not None and entry['state'] == 'done':
+                for file in entry['new_files']:
+                    relative_path = os.path.join(os.path.basename(os.path.dirname(file)), os.path.basename(file))
+                    if {'filename' : relative_path} not in rows:
+                        rows += [{'filename' : relative_path}]
+
+        with open(filename, 'w') as fd:
+            csv_writer = csv.DictWriter(fd, ['filename'], dialect=self.dialect)
+            csv_writer.writeheader()
+            csv_writer.writerows(rows)
+
+    def convert_to_bids(self, name, n_jobs=1, journal_path=None, copy_mode='link', n_threads=4):
         if not os.path.exists(BIDS_PATH):
             os.makedirs(BIDS_PATH)
 
         self.write_bids_description(name)
         self.write_bids_ignore()
 
+        if journal_path is None:
+            journal_path = JOURNAL_PATH
+        journal = scheduler.Journal(journal_path)
+
+        tasks = []
         for count in range(len(self)):
+            tasks += self._prepare_subject(count, journal, copy_mode, n_threads)
 
-            subject = self[count]
+        updated = set()
+        if n_jobs == 1:
+            results = map(_run_conversion_task, tasks)
+        else:
+            executor = concurrent.futures.ProcessPoolExecutor(n_jobs)
+            futures = [executor.submit(profiling.remote(_run_conversion_task), task) for task in tasks]
+            results = profiling.gather(future.result() for future in concurrent.futures.as_completed(futures))
+
+        for result in results:
+            print(result['key'], result['state'], '(%.1fs)' %result['duration'])
+            journal.set(result.pop('key'), **result)
+            updated.add(result['subject'])
+
+        if n_jobs != 1:
+            executor.shutdown()
 
-            if os.path.exists(subject.data_path):
-                
-                sub_key = 'sub-%02d' %(count + 1)
-                bids_folder = os.path.join(BIDS_PATH, sub_key)
-
-                if not os.path.exists(bids_folder):
-                    shutil.copytree(subject.data_path, bids_folder)
-                    
-                    #shutil.rmtree(os.path.join(bids_folder, 'run 5'))
-                    #print('rm %s/*.xlsx' %bids_folder)
-                    os.system('rm %s/*.xlsx' %bids_folder)
-                    subject.set_new_key(sub_key)
-                    
-                    filename = os.path.join(bids_folder, '%s_scans.tsv' %(sub_key))
-                    fd = open(filename, 'w')
-                    
-                    csv_writer = csv.DictWriter(fd, ['filename'], dialect=self.dialect)
-
-                    folders = os.listdir(bids_folder)
-                    rows = []
-
-                    for run_id in range(1, 6):
-                        path = os.path.join(bids_folder, f'run {run_id}')
-                        if os.path.isdir(path):
-
-                            pattern = '%s' %(sub_key)
-
-                            files = os.listdir(path)
-
-                            if len(files) == 2:
-                                type_converter = self.converters['fmri'][2]
-                                task_name = f'task-morph_run-{run_id}_bold'
-                                target_folder = self.converters['fmri'][0]
-                                print(path, target_folder)
-                                converter = type_converter(path, target_folder)
-                                converter.convert(pattern, task_name)
-                                converter.clean()
-                            else:
-                                type_converter = DICOMtoNIFTIConverter
-                                task_name = f'task-morph_run-{run_id}_bold'
-                                target_folder = self.converters['fmri'][0]
-                                print(path, target_folder)
-                                converter = type_converter(path, target_folder)
-                                converter.convert(pattern, task_name)
-                                converter.clean()
-
-                            all_files = converter.new_files
-
-                            for file in all_files:
-                                relative_path = os.path.join(os.path.basename(os.path.dirname(file)), os.path.basename(file))
-                                rows += [{'filename' : relative_path}]
-
-                    for folder in ['anat']:
-                        path = os.path.join(bids_folder, folder)
-                        if os.path.isdir(path):
-
-                            pattern = '%s' %(sub_key)
-
-                            files = os.listdir(path)
-
-                            if len(files) == 2:
-                                type_converter = self.converters[folder][2]
-                                task_name = self.converters[folder][1]
-                                target_folder = self.converters[folder][0]
-                                print(path, target_folder)
-                                converter = type_converter(path, target_folder)
-                                converter.convert(pattern, task_name)
-                                converter.clean()
-                            else:
-                                type_converter = DICOMtoNIFTIConverter
-                                task_name = self.converters[folder][1]
-                                target_folder = self.converters[folder][0]
-                                print(path, target_folder)
-                                converter = type_converter(path, target_folder)
-                                converter.convert(pattern, task_name)
-                                converter.clean()
-
-                            all_files = converter.new_files
-
-                            for file in all_files:
-                                relative_path = os.path.join(os.path.basename(os.path.dirname(file)), os.path.basename(file))
-                                rows += [{'filename' : relative_path}]
-
-                    csv_writer.writeheader()
-                    csv_writer.writerows(rows)
-                    fd.close()
+        for sub_key in sorted(updated):
+            self.write_bids_scans(sub_key, journal)
+
+        failed = [key for key, value in journal.items() if value['state'] == 'failed']
+        if len(failed) > 0:
+            print('Conversion failed for', ', '.join(failed))
 
         self.write_bids_participants()
 
 
+class ConversionTask(object):
+
+    def __init__(self, subject, folder, path, type_converter, target_folder, task_name, checksums=None):
+        self.subject = subject
+        self.folder = folder
+        self.path = path
+        self.type_converter = type_converter
+        self.target_folder = target_folder
+        self.task_name = task_name
+        if checksums is not None:
+            checksums = {key : value for key, value in checksums.items()
+                         if key.startswith(os.path.abspath(path) + os.sep)}
+        self.checksums = checksums
+
+    @property
+    def key(self):
+        return '%s/%s' %(self.subject, self.folder)
+
+
+def _run_conversion_task(task):
+    result = {'key' : task.key, 'subject' : task.subject, 'new_files' : [], 'logs' : []}
+    t_start = time.time()
+    print(task.path, task.target_folder)
+    converter = task.type_converter(task.path, task.target_folder)
+    converter.checksums = task.checksums
+    try:
+        with profiling.span('convert', sub=task.subject, folder=task.folder):
+            converter.convert(task.subject, task.task_name)
+        for file in converter.new_files:
+            if not os.path.exists(file):
+                raise RuntimeError('%s was not created' %file)
+        converter.clean()
+        result['state'] = 'done'
+    except Exception as error:
+        result['state'] = 'failed'
+        result['error'] = str(error)
+    result['new_files'] = converter.new_files
+    result['logs'] = converter.logs
+    result['duration'] = time.time() - t_start
+    return result
+
+
+class LazyRuns(collections.abc.Sequence):
+
+    def __init__(self, database, subject, verbose=False):
+        self.database = database
+        self.subject = subject
+        self.verbose = verbose
+        self._files = None
+
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = self.database._get_filenames('func', self.subject)
+        return self._files
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if self.verbose:
+            print('Loading bold sequence', self.files[i])
+        return self.database._get_mri(self.files[i], self.subject)
+
+    def __repr__(self):
+        return 'LazyRuns(subject=%s, runs=%d)' %(self.subject, len(self))
+
+
+class LazySubjects(collections.abc.Mapping):
+
+    def __init__(self, getter, subjects):
+        self._getter = getter
+        self._subjects = list(subjects)
+        self._values = {}
+
+    def __getitem__(self, subject):
+        if subject not in self._subjects:
+            raise KeyError(subject)
+        if subject not in self._values:
+            self._values[subject] = self._getter(subject)
+        return self._values[subject]
+
+    def __iter__(self):
+        return iter(self._subjects)
+
+    def __len__(self):
+        return len(self._subjects)
+
+    def __repr__(self):
+        return 'LazySubjects(%s)' %', '.join(self._subjects)
+
 
 class BIDSDatabase(object):
 
-    def __init__(self, bids_path, result_path, index=False):
-        import bids
+    def __init__(self, bids_path, result_path, index=False, mri_cache_size=None):
+        import pandas
         self.bids_path = bids_path
         self.sql_data = os.path.join(os.path.dirname(self.bids_path), 'database.bids')
-        if not os.path.exists(self.sql_data):
-            self.bids = bids.BIDSLayout(self.bids_path, validate=False, database_path=self.sql_data)
-        else:
-            if index:
-                self.bids = bids.BIDSLayout(self.bids_path, validate=False, database_path=self.sql_data, reset_database=True)
-            else:
-                self.bids = bids.BIDSLayout(self.bids_path, validate=False, database_path=self.sql_data)
+        self._index = index
+        self._bids = None
+        with profiling.span('layout index'):
+            self.layout = indexing.LayoutIndex(self.bids_path, reset=index)
         self.result_path = result_path
-        self.participants = self.bids.get_file('participants.tsv').get_df()
+        self.participants = pandas.read_csv(os.path.join(self.bids_path, 'participants.tsv'), sep='\t',
+                                            na_values=['n/a'])
+        if mri_cache_size is None:
+            mri_cache_size = MRI_CACHE_SIZE
+        self._mris = cache.LRUCache(mri_cache_size)
+
+    @property
+    def bids(self):
+        if self._bids is None:
+            import bids
+            with profiling.span('BIDSLayout'):
+                if not os.path.exists(self.sql_data):
+                    self._bids = bids.BIDSLayout(self.bids_path, validate=False, database_path=self.sql_data)
+                else:
+                    self._bids = bids.BIDSLayout(self.bids_path, validate=False, database_path=self.sql_data,
+                                                 reset_database=self._index)
+        return self._bids
+
+    def update_index(self):
+        with profiling.span('layout update'):
+            return self.layout.update()
 
     def __len__(self):
         return self.nb_subjects
@@ -392,7 +558,7 @@ class BIDSDatabase(object):
             os.makedirs(path)
         return path
 
-    def _get_all_partial(self, data, subjects=None, verbose=False, filters=None):
+    def _get_all_partial(self, data, subjects=None, verbose=False, filters=None, lazy=False):
         result = {}
         
         if subjects is None:
@@ -401,8 +567,13 @@ class BIDSDatabase(object):
         if filters is not None:
             subjects = self.slice_subjects(filters)
 
+        subjects = [self._get_subject_key(subject) for subject in subjects]
+
+        if lazy:
+            getter = getattr(self, 'get_' + data)
+            return LazySubjects(lambda subject: getter(subject, verbose, lazy=True), subjects)
+
         for subject in subjects:
-            subject = self._get_subject_key(subject)
             if data == 'func':
                 result[subject] = self.get_func(subject, verbose)
             elif data == 'anat':
@@ -411,77 +582,262 @@ class BIDSDatabase(object):
 
     def _get_filenames(self, data, subject):
         subject = self._get_subject_key(subject)
-        filenames = self.bids.get(return_type='filename', subject=subject, datatype=data, extension='nii.gz')
+        filenames = self.layout.get(subject=subject, datatype=data, extension='nii.gz')
         return filenames
 
 
-    def get_func(self, subject, verbose=False):
+    def _get_mri(self, filename, subject):
+        result = self._mris.get(filename)
+        if result is None:
+            result_path = self._get_result_path(subject, 'func')
+            try:
+                result = mri.MRI(filename, result_path)
+            except Exception:
+                return None
+            self._mris.set(filename, result)
+        return result
+
+    def get_func(self, subject, verbose=False, lazy=False):
         if verbose:
             print('Loading bold sequence for subject', subject)
 
-        result_path = self._get_result_path(subject, 'func')
-        
-        files = self._get_filenames('func', subject)
-        res = []
-        for file in files:
-            try:
-                res += [mri.MRI(file, result_path)]
-            except Exception:
-                res += [None]
-        return res
+        runs = LazyRuns(self, self._get_subject_key(subject))
+        if lazy:
+            return runs
+        return list(runs)
 
-    def get_all_func(self, subjects=None, verbose=False, filters=None):
-        return self._get_all_partial('func', subjects, verbose, filters)
+    def get_all_func(self, subjects=None, verbose=False, filters=None, lazy=True):
+        return self._get_all_partial('func', subjects, verbose, filters, lazy)
 
 
-    def launch_fmriprep(self, use_aroma=False, nprocs=72, subset=None, work_folder=None):
-        if work_folder is None:
-            work_folder = os.path.join(os.path.dirname(self.bids_path), 'work')
+    def get_decoding_data(self, store, subjects=None, runs=range(0, 4), mode='stim_vs_all', group_by='subject',
+                          repetition_time=decoding.REPETITION_TIME, cleaned=False, n_jobs=1):
+        # samples are the preprocessed volumes standardized over the brain mask, cleaned=True switches
+        # to the confound-regressed and run-wise standardized volumes instead
+        if subjects is None:
+            subjects = range(1, self.nb_subjects+1)
+        subjects = list(subjects)
+        runs = list(runs)
+
+        # every run is sized up front so that the samples can be written in place, missing runs are skipped
+        tasks = []
+        for group, subject in enumerate(subjects):
+            all_runs = self.get_func(subject, lazy=True)
+            for run_id in runs:
+                if run_id >= len(all_runs) or all_runs[run_id] is None:
+                    continue
+                run = all_runs[run_id]
+                volumes, run_labels = decoding.get_trial_volumes(store, subject, run_id, run.nb_volumes,
+                                                                 mode, repetition_time)
+                if group_by == 'subject':
+                    run_group = group
+                else:
+                    run_group = group * len(runs) + run_id
+                tasks += [(run, volumes, run_labels, run_group)]
+
+        if not tasks:
+            raise ValueError('No run found for subjects %s and runs %s' %(subjects, runs))
+        reference = tasks[0][0].brain_mask
+        voxels = decoding.get_common_voxels([task[0] for task in tasks])
+        offsets = numpy.cumsum([0] + [len(task[1]) for task in tasks])
+        features = numpy.empty((offsets[-1], len(voxels)), dtype=numpy.float32)
+        labels = numpy.empty(offsets[-1], dtype=int)
+        groups = numpy.empty(offsets[-1], dtype=int)
+
+        def fill(count):
+            run, volumes, run_labels, run_group = tasks[count]
+            rows = slice(offsets[count], offsets[count + 1])
+            flat_indices = numpy.ravel_multi_index(run.mask_indices, reference.shape[:3])
+            columns = numpy.searchsorted(flat_indices, voxels)
+            features[rows] = run.get_timeseries(volumes, columns, cleaned)
+            labels[rows] = run_labels
+            groups[rows] = run_group
+            run.clear_cache()
+
+        with profiling.span('decoding data', nb_runs=len(tasks), nb_voxels=len(voxels)):
+            if n_jobs == 1:
+                for count in range(len(tasks)):
+                    fill(count)
+            else:
+                with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+                    list(executor.map(fill, range(len(tasks))))
 
-        command = 'fmriprep-docker %s %s participant -w %s --nthreads %d --verbose --notrack' %(self.bids_path, self.result_path, work_folder, nprocs)
+        return {'features' : features, 'labels' : labels, 'groups' : groups, 'voxels' : voxels,
+                'shape' : reference.shape[:3], 'affine' : reference.affine}
 
-        print(command)
-        all_funcs = self.bids.get(datatype='func')
-        all_subjects = []
-        for func in all_funcs:
-            if func.subject not in all_subjects:
-                all_subjects += [func.subject]
+    def iter_runs(self, subjects=None, runs=range(0, 4), attributes=('preprocessed',), prefetch=2,
+                  memory_limit=None, n_jobs=1, release=True):
+        # yields (subject, run, MRI) in order while the next runs are loaded in background threads
+        if subjects is None:
+            subjects = range(1, self.nb_subjects+1)
+        keys = [(subject, run_id) for subject in subjects for run_id in runs]
+
+        def get_run(key):
+            subject, run_id = key
+            all_runs = self.get_func(subject, lazy=True)
+            if run_id >= len(all_runs):
+                return None
+            return all_runs[run_id]
+
+        def load(key):
+            run = get_run(key)
+            if run is not None:
+                for name in attributes:
+                    run.preload(name)
+            return run
+
+        def get_size(key):
+            run = get_run(key)
+            return 0 if run is None else run.nbytes * len(attributes)
+
+        executor = concurrent.futures.ThreadPoolExecutor(n_jobs)
+        pending = collections.deque()
+        submitted = 0
+        try:
+            for key in keys:
+                in_flight = sum(size for future, size in pending)
+                while submitted < len(keys) and len(pending) <= prefetch:
+                    size = get_size(keys[submitted])
+                    if memory_limit is not None and len(pending) > 0 and in_flight + size > memory_limit:
+                        break
+                    pending.append((executor.submit(load, keys[submitted]), size))
+                    in_flight += size
+                    submitted += 1
+                future, size = pending.popleft()
+                run = future.result()
+                yield key[0], key[1], run
+                if release and run is not None:
+                    run.clear_cache()
+        finally:
+            for future, size in pending:
+                future.cancel()
+            executor.shutdown()
+
+    def get_parceled_timeseries(self, subjects=None, runs=range(0, 4), n_jobs=1):
+        if subjects is None:
+            subjects = range(1, self.nb_subjects+1)
+        keys = [(subject, run) for subject in subjects for run in runs]
+
+        def parcellate(key):
+            subject, run = key
+            all_runs = self.get_func(subject, lazy=True)
+            if run >= len(all_runs) or all_runs[run] is None:
+                return None
+            mri_run = all_runs[run]
+            values = mri_run.masked_normalized_cleaned_parceled_values
+            # the 4D images behind the values are not needed anymore
+            mri_run.clear_cache()
+            return values
+
+        with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+            return dict(zip(keys, executor.map(parcellate, keys)))
+
+    def get_connectivity(self, subjects=None, runs=range(0, 4), kinds=('correlation',), fisher_z=True,
+                         output_path=None, n_jobs=1):
+        from nilearn.connectome import ConnectivityMeasure
 
+        if subjects is None:
+            subjects = range(1, self.nb_subjects+1)
+        subjects = list(subjects)
+        runs = list(runs)
+        time_series = self.get_parceled_timeseries(subjects, runs, n_jobs)
+        keys = [key for key, value in time_series.items() if value is not None]
+        nb_regions = set(time_series[key].shape[1] for key in keys)
+        if len(nb_regions) != 1:
+            raise ValueError('Runs do not share the same parcellation: %s' %sorted(nb_regions))
+        nb_regions = nb_regions.pop()
+
+        results = {}
+        for kind in kinds:
+            measure = ConnectivityMeasure(kind=kind)
+            with profiling.span('connectivity', kind=kind, nb_runs=len(keys)):
+                matrices = measure.fit_transform([time_series[key] for key in keys])
+            stacked = numpy.full((len(subjects), len(runs), nb_regions, nb_regions), numpy.nan, dtype=numpy.float32)
+            for (subject, run), matrix in zip(keys, matrices):
+                stacked[subjects.index(subject), runs.index(run)] = matrix
+            results[kind] = {'matrices' : stacked}
+
+            if fisher_z and kind in ['correlation', 'partial correlation']:
+                # runs of a subject are not independent samples, they are averaged before the group statistics
+                with numpy.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+                    warnings.simplefilter('ignore', RuntimeWarning)
+                    z_values = numpy.arctanh(numpy.clip(stacked, -0.999999, 0.999999))
+                    subject_z = numpy.nanmean(z_values, axis=1)
+                    nb_samples = numpy.sum(~numpy.isnan(subject_z), axis=0)
+                    mean = numpy.nanmean(subject_z, axis=0)
+                    std = numpy.nanstd(subject_z, axis=0, ddof=1)
+                    results[kind]['fisher_z'] = z_values
+                    results[kind]['subject_fisher_z'] = subject_z
+                    results[kind]['mean'] = mean
+                    results[kind]['t'] = mean / (std / numpy.sqrt(nb_samples))
+
+            if output_path is not None:
+                if not os.path.exists(output_path):
+                    os.makedirs(output_path)
+                for name, values in results[kind].items():
+                    numpy.save(os.path.join(output_path, '%s_%s.npy' %(kind.replace(' ', '_'), name)),
+                               numpy.asarray(values, dtype=numpy.float32))
+        return results
+
+    def _get_participants(self, subset=None):
+        all_subjects = self.layout.get_subjects(datatype='func')
         if subset == 'odd':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects[::2])
+            return all_subjects[::2]
         elif subset == 'not-odd':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects[1::2])
-        elif subset == 'all':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects)
-
-        if use_aroma:
-            command += ' --use-aroma'
-        os.system(command)
+            return all_subjects[1::2]
+        elif subset is None or subset == 'all':
+            return all_subjects
+        return [self._get_subject_key(subject) for subject in subset]
 
-    def launch_xcp_d(self, nprocs=72, subset=None, work_folder=None):
+    def _launch(self, pipeline, command, options, subset, work_folder, concurrency, is_complete, only_failed):
         if work_folder is None:
             work_folder = os.path.join(os.path.dirname(self.bids_path), 'work')
 
-        command = 'xcp_d %s %s participant -w %s --nthreads %d --verbose --despike' %(self.bids_path, self.result_path, work_folder, nprocs)
+        jobs = []
+        for label in self._get_participants(subset):
+            subject_key = self._get_subject_key(label, 'sub-')
+            job_command = list(command) + [self.bids_path, self.result_path, 'participant',
+                                           '--participant-label', label,
+                                           '-w', os.path.join(work_folder, pipeline, subject_key)] + options
+            job_complete = None
+            if is_complete is not None:
+                job_complete = lambda subject_key=subject_key: is_complete(subject_key)
+            jobs += [scheduler.Job(subject_key, job_command, job_complete)]
+
+        jobs_scheduler = scheduler.Scheduler(os.path.join(work_folder, 'logs', pipeline), concurrency)
+        jobs_scheduler.run(jobs, only_failed=only_failed)
+        failed = jobs_scheduler.failed
+        if len(failed) > 0:
+            print('%s failed for' %pipeline, ', '.join(failed))
+        return jobs_scheduler.summary
+
+    def launch_fmriprep(self, use_aroma=False, nprocs=72, subset=None, work_folder=None, concurrency=1,
+                        mem_mb=None, command='fmriprep-docker', only_failed=False):
+        # each of the concurrent participants gets its share of the threads and memory
+        options = ['--nthreads', str(max(1, nprocs // concurrency)), '--verbose', '--notrack']
+        if mem_mb is not None:
+            options += ['--mem-mb', str(int(mem_mb // concurrency))]
+        if use_aroma:
+            options += ['--use-aroma']
+
+        def is_complete(subject_key):
+            return os.path.exists(os.path.join(self.result_path, '%s.html' %subject_key))
 
-        print(command)
-        all_funcs = self.bids.get(datatype='func')
-        all_subjects = []
-        for func in all_funcs:
-            if func.subject not in all_subjects:
-                all_subjects += [func.subject]
+        return self._launch('fmriprep', command.split(), options, subset, work_folder, concurrency,
+                            is_complete, only_failed)
 
-        if subset == 'odd':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects[::2])
-        elif subset == 'not-odd':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects[1::2])
-        elif subset == 'all':
-            command += ' --participant-label '
-            command += ' '.join(all_subjects)
+    def launch_xcp_d(self, nprocs=72, subset=None, work_folder=None, concurrency=1, mem_gb=None,
+                     command='xcp_d', only_failed=False):
+        options = ['--nthreads', str(max(1, nprocs // concurrency)), '--verbose', '--despike']
+        if mem_gb is not None:
+            options += ['--mem-gb', str(max(1, int(mem_gb // concurrency)))]
+
+        def is_complete(subject_key):
+            # xcp_d writes its report and outputs in <result_path>/xcp_d
+            path = os.path.join(self.result_path, 'xcp_d')
+            func_path = os.path.join(path, subject_key, 'func')
+            return (os.path.exists(os.path.join(path, '%s.html' %subject_key)) and os.path.isdir(func_path)
+                    and len(os.listdir(func_path)) > 0)
 
-        os.system(command)
+        return self._launch('xcp_d', command.split(), options, subset, work_folder, concurrency,
+                            is_complete, only_failed)
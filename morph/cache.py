@@ -0,0 +1,215 @@
+import os
+import gzip
+import shutil
+import hashlib
+import weakref
+import threading
+import collections
+import numpy
+import nibabel
+
+
+def file_signature(filename, use_hash=False):
+    if filename is None or not os.path.exists(filename):
+        return (filename, None)
+    stat = os.stat(filename)
+    signature = (os.path.abspath(filename), stat.st_mtime_ns, stat.st_size)
+    if use_hash:
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        signature += (md5.hexdigest(),)
+    return signature
+
+
+def make_key(*items):
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+# mirror files referenced by live images in this process, shared by every NiftiMirror
+_pinned = collections.Counter()
+_pinned_lock = threading.Lock()
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size=8):
+        self.max_size = max_size
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        if self.max_size is not None and self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            if self.max_size is not None:
+                while len(self._data) > self.max_size:
+                    self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DiskCache(object):
+
+    def __init__(self, path, max_size=None, extension='.npy'):
+        self.path = path
+        self.max_size = max_size
+        self.extension = extension
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def get_filename(self, key):
+        return os.path.join(self.path, key + self.extension)
+
+    def __contains__(self, key):
+        return os.path.exists(self.get_filename(key))
+
+    def get(self, key, default=None, mmap_mode=None):
+        filename = self.get_filename(key)
+        try:
+            value = numpy.load(filename, mmap_mode=mmap_mode)
+        except (OSError, ValueError):
+            return default
+        # access time is the LRU clock, atime may be disabled on the mount
+        os.utime(filename)
+        return value
+
+    def set(self, key, value):
+        filename = self.get_filename(key)
+        tmp_filename = filename + '.%d.tmp' %os.getpid()
+        with open(tmp_filename, 'wb') as f:
+            numpy.save(f, numpy.asarray(value))
+        os.replace(tmp_filename, filename)
+        self.evict()
+        return filename
+
+    def pop(self, key):
+        filename = self.get_filename(key)
+        if os.path.exists(filename):
+            os.remove(filename)
+
+    @property
+    def entries(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(self.extension):
+                stat = entry.stat()
+                entries += [(stat.st_mtime, stat.st_size, entry.path)]
+        return sorted(entries)
+
+    @property
+    def size(self):
+        return sum(i[1] for i in self.entries)
+
+    def evict(self, keep=()):
+        if self.max_size is None:
+            return
+        entries = self.entries
+        total = sum(i[1] for i in entries)
+        for mtime, size, filename in entries:
+            if total <= self.max_size:
+                break
+            if filename in keep:
+                continue
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in self.entries:
+            os.remove(entry[2])
+
+
+class NiftiMirror(object):
+
+    def __init__(self, path, max_size=None):
+        # the disk cache only provides the file naming and the LRU eviction, entries are written by get
+        self.files = DiskCache(path, max_size, extension='.nii')
+
+    @property
+    def path(self):
+        return self.files.path
+
+    def get_key(self, source):
+        name = os.path.basename(source).split('.')[0]
+        return name + '_' + make_key(file_signature(source))[:16]
+
+    def get(self, source, create=True):
+        # uncompressed copy of a .nii.gz, keyed on its path and mtime so that it can be memory-mapped
+        if not source.endswith('.gz'):
+            return source
+        filename = self.files.get_filename(self.get_key(source))
+        if os.path.exists(filename):
+            os.utime(filename)
+            return filename
+        if not create:
+            return source
+        tmp_filename = filename + '.%d.%d.tmp' %(os.getpid(), threading.get_ident())
+        with gzip.open(source, 'rb') as f_in, open(tmp_filename, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 1 << 22)
+        os.replace(tmp_filename, filename)
+        self.files.evict(keep=self.pinned | {filename})
+        return filename
+
+    def load(self, source, create=True):
+        # nibabel reopens the file on every data access, so the mirror is pinned for as long as the image lives
+        filename = self.get(source, create)
+        image = nibabel.load(filename)
+        if filename != source:
+            self.pin(filename)
+            weakref.finalize(image, self.unpin, filename)
+        return image
+
+    @property
+    def pinned(self):
+        with _pinned_lock:
+            return set(_pinned)
+
+    def pin(self, filename):
+        with _pinned_lock:
+            _pinned[filename] += 1
+
+    def unpin(self, filename):
+        with _pinned_lock:
+            _pinned[filename] -= 1
+            if _pinned[filename] <= 0:
+                del _pinned[filename]
+
+    def pop(self, key):
+        filename = self.files.get_filename(key)
+        if filename not in self.pinned:
+            self.files.pop(key)
+
+    def clear(self):
+        pinned = self.pinned
+        for entry in self.files.entries:
+            if entry[2] not in pinned:
+                os.remove(entry[2])
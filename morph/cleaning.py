@@ -0,0 +1,112 @@
+import os
+import tempfile
+import concurrent.futures
+import numpy
+import nibabel
+from nilearn import signal
+from nilearn import image
+
+CHUNK_SIZE = 8192
+# float64 copies of a chunk alive at once: input, projection and standardization
+CHUNK_COPIES = 4
+
+
+def get_operator(nb_volumes, confounds=None, detrend=True, low_pass=None, high_pass=None, t_r=None):
+    # everything signal.clean does before standardizing (detrending, butterworth filtering and the
+    # confound projection) is linear in the signals, so cleaning the identity gives the
+    # (time x time) matrix that is applied to every voxel
+    return signal.clean(numpy.eye(nb_volumes), detrend=detrend, standardize=False, confounds=confounds,
+                        low_pass=low_pass, high_pass=high_pass, t_r=t_r)
+
+
+def get_chunk_size(nb_volumes, memory_limit=None, n_jobs=1):
+    if memory_limit is None:
+        return CHUNK_SIZE
+    return int(max(1, memory_limit // (CHUNK_COPIES * 8 * nb_volumes * max(1, n_jobs))))
+
+
+def _clean_chunk(signals, operator, columns, standardize, t_r):
+    values = operator.dot(numpy.asarray(signals[:, columns], dtype=numpy.float64))
+    if standardize:
+        values = signal.clean(values, detrend=False, standardize=standardize, t_r=t_r)
+    signals[:, columns] = values
+
+
+def clean_signals(signals, operator, standardize=True, t_r=None, columns=None, chunk_size=CHUNK_SIZE, n_jobs=1):
+    # cleans a (time x voxels) float32 array in place, chunk_size voxels at a time
+    if columns is None:
+        chunks = [slice(i, i + chunk_size) for i in range(0, signals.shape[1], chunk_size)]
+    else:
+        chunks = [columns[i:i + chunk_size] for i in range(0, len(columns), chunk_size)]
+
+    if n_jobs == 1:
+        for chunk in chunks:
+            _clean_chunk(signals, operator, chunk, standardize, t_r)
+    else:
+        with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+            list(executor.map(lambda chunk: _clean_chunk(signals, operator, chunk, standardize, t_r), chunks))
+    return signals
+
+
+def _open(img):
+    filename = img.get_filename()
+    if filename is not None:
+        # keep the file open so that compressed volumes are decompressed in a single pass
+        img = nibabel.load(filename, keep_file_open=True)
+    return img
+
+
+def _allocate(shape, in_memory=True, temp_dir=None):
+    if in_memory:
+        return numpy.empty(shape, dtype=numpy.float32, order='F')
+    handle, filename = tempfile.mkstemp(suffix='.npy', dir=temp_dir)
+    os.close(handle)
+    data = numpy.lib.format.open_memmap(filename, mode='w+', dtype=numpy.float32, shape=shape, fortran_order=True)
+    # the mapping keeps the file content alive, it is released with the array
+    os.remove(filename)
+    return data
+
+
+def _load_float32(img, in_memory=True, temp_dir=None):
+    img = _open(img)
+    data = _allocate(img.shape, in_memory, temp_dir)
+    for volume in range(img.shape[3]):
+        data[..., volume] = img.dataobj[..., volume]
+    return data
+
+
+def load_masked(img, mask):
+    # (time x voxels) float32 signals of the voxels where mask is true, read volume by volume
+    img = _open(image.load_img(img))
+    signals = numpy.empty((img.shape[3], int(mask.sum())), dtype=numpy.float32)
+    for volume in range(img.shape[3]):
+        signals[volume] = numpy.asanyarray(img.dataobj[..., volume])[mask]
+    return signals
+
+
+def clean_img(img, confounds=None, detrend=True, standardize=True, low_pass=None, high_pass=None, t_r=None,
+              mask_img=None, memory_limit=None, n_jobs=1, temp_dir=None):
+    # same output as nilearn.image.clean_img, in float32 and without a float64 copy of the run
+    # when the run takes more than half of memory_limit, it is cleaned in a temporary memory-mapped
+    # file (in temp_dir) that backs the returned image, and only the chunks being cleaned are in memory
+    img = image.load_img(img)
+    nb_volumes = img.shape[3]
+    in_memory = memory_limit is None or 4 * numpy.prod(img.shape) <= memory_limit // 2
+    data = _load_float32(img, in_memory, temp_dir)
+    signals = data.reshape(-1, nb_volumes, order='F').T
+
+    columns = None
+    if mask_img is not None:
+        mask = numpy.asanyarray(image.load_img(mask_img).dataobj) > 0
+        columns = numpy.flatnonzero(mask.ravel(order='F'))
+        data[~mask] = 0
+
+    operator = get_operator(nb_volumes, confounds, detrend, low_pass, high_pass, t_r)
+    if memory_limit is not None and in_memory:
+        memory_limit -= data.nbytes
+    chunk_size = get_chunk_size(nb_volumes, memory_limit, n_jobs)
+    clean_signals(signals, operator, standardize, t_r, columns, chunk_size, n_jobs)
+
+    header = img.header.copy()
+    header.set_data_dtype(numpy.float32)
+    return nibabel.Nifti1Image(data, img.affine, header)
@@ -0,0 +1,139 @@
+import numpy
+import nibabel
+import atlases
+import profiling
+
+REPETITION_TIME = 2.39951
+
+
+def get_trial_volumes(store, subject, run, nb_volumes, mode='stim_vs_all', repetition_time=REPETITION_TIME):
+    run_labels = store.query(int(subject), run=run + 1, columns=['run time', 'response'])
+    times = numpy.around(numpy.asarray(run_labels['run time']) / (1000*repetition_time)).astype(int)
+    if mode == 'stim_vs_all':
+        volumes = numpy.arange(nb_volumes)
+        labels = numpy.isin(volumes, times).astype(int)
+    elif mode == 'human_responses':
+        volumes = times
+        labels = numpy.asarray(run_labels['response']).astype(int)
+    else:
+        raise ValueError('Unknown mode %s' %mode)
+    return volumes, labels
+
+
+def get_common_voxels(runs):
+    common = None
+    for run in runs:
+        flat_indices = numpy.ravel_multi_index(run.mask_indices, run.brain_mask.shape[:3])
+        common = flat_indices if common is None else numpy.intersect1d(common, flat_indices, assume_unique=True)
+    return common
+
+
+class Dataset(object):
+
+    def __init__(self, database, store, subjects, runs=range(0, 4), mode='stim_vs_all', group_by='subject',
+                 repetition_time=REPETITION_TIME, cv=None, n_jobs=1):
+        self.database = database
+        self.store = store
+        self.subjects = list(subjects)
+        self.runs = runs
+        self.mode = mode
+        self.group_by = group_by
+        self.repetition_time = repetition_time
+        self.cv = cv
+        self._folds = None
+
+        data = self.database.get_decoding_data(self.store, self.subjects, self.runs, self.mode, self.group_by,
+                                               self.repetition_time, n_jobs=n_jobs)
+        self.shape = data['shape']
+        self.affine = data['affine']
+        self.voxels = data['voxels']
+        self.features = data['features']
+        self.labels = data['labels']
+        self.groups = data['groups']
+
+    @property
+    def folds(self):
+        if self._folds is None:
+            cv = self.cv
+            if cv is None:
+                from sklearn.model_selection import LeaveOneGroupOut
+                cv = LeaveOneGroupOut()
+            self._folds = list(cv.split(self.features, self.labels, self.groups))
+        return self._folds
+
+    @property
+    def mask_img(self):
+        data = numpy.zeros(numpy.prod(self.shape), dtype=numpy.uint8)
+        data[self.voxels] = 1
+        return nibabel.Nifti1Image(data.reshape(self.shape), self.affine)
+
+    def to_img(self, values):
+        data = numpy.zeros(numpy.prod(self.shape), dtype=numpy.float32)
+        data[self.voxels] = values
+        return nibabel.Nifti1Image(data.reshape(self.shape), self.affine)
+
+    def get_neighbourhoods(self, radius=6):
+        indices = numpy.unravel_index(self.voxels, self.shape)
+        return atlases.get_spatial_index(indices, self.affine).query_voxels(radius)
+
+
+def _default_estimator():
+    from sklearn.svm import LinearSVC
+    return LinearSVC()
+
+
+def _score_folds(estimator, features, labels, folds, scoring):
+    from sklearn.base import clone
+    from sklearn.metrics import get_scorer
+    scorer = get_scorer(scoring)
+    scores = numpy.zeros(len(folds))
+    for count, (train, test) in enumerate(folds):
+        model = clone(estimator).fit(features[train], labels[train])
+        scores[count] = scorer(model, features[test], labels[test])
+    return scores
+
+
+def _score_fold(estimator, features, labels, train, test, scoring):
+    return _score_folds(estimator, features, labels, [(train, test)], scoring)[0]
+
+
+def _searchlight_chunk(estimator, features, labels, folds, scoring, neighbourhoods):
+    scores = numpy.zeros(len(neighbourhoods))
+    for count, neighbourhood in enumerate(neighbourhoods):
+        scores[count] = numpy.mean(_score_folds(estimator, features[:, neighbourhood], labels, folds, scoring))
+    return scores
+
+
+class Decoder(object):
+
+    def __init__(self, dataset, estimator=None, scoring='roc_auc', n_jobs=1):
+        self.dataset = dataset
+        self.estimator = estimator if estimator is not None else _default_estimator()
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+
+    def cross_validate(self, estimator=None, voxels=None):
+        from joblib import Parallel, delayed
+        if estimator is None:
+            estimator = self.estimator
+        features = self.dataset.features
+        if voxels is not None:
+            features = features[:, voxels]
+        with profiling.span('cross validation', nb_features=features.shape[1]):
+            return numpy.array(Parallel(n_jobs=self.n_jobs)(
+                delayed(_score_fold)(estimator, features, self.dataset.labels, train, test, self.scoring)
+                for train, test in self.dataset.folds))
+
+    def searchlight(self, radius=6, estimator=None, chunk_size=64):
+        from joblib import Parallel, delayed
+        if estimator is None:
+            estimator = self.estimator
+        neighbourhoods = self.dataset.get_neighbourhoods(radius)
+        chunks = [neighbourhoods[i:i + chunk_size] for i in range(0, len(neighbourhoods), chunk_size)]
+        with profiling.span('searchlight', radius=radius, nb_spheres=len(neighbourhoods)):
+            scores = Parallel(n_jobs=self.n_jobs)(
+                delayed(_searchlight_chunk)(estimator, self.dataset.features, self.dataset.labels,
+                    self.dataset.folds, self.scoring, chunk) for chunk in chunks)
+        self.scores_ = numpy.concatenate(scores)
+        self.scores_img_ = self.dataset.to_img(self.scores_)
+        return self.scores_img_
@@ -0,0 +1,420 @@
+import os
+import json
+import concurrent.futures
+import numpy
+import pandas
+import joblib
+from nilearn import image
+import mri
+import cache
+import profiling
+import cleaning
+
+REPETITION_TIME = 2.39951
+ALL_MORPHS = numpy.arange(5, 105, 10)
+
+
+def make_contrasts(design_matrix, morph_level):
+    contrast_matrix = numpy.eye(design_matrix.shape[1])
+    contrasts = {column : contrast_matrix[i] for i, column in enumerate(design_matrix.columns)}
+    for level in ALL_MORPHS:
+        condition = f'morph_{level}'
+        contrasts[condition] = numpy.sum(
+            [contrasts[name] for name in design_matrix.columns if name[: len(condition)] == condition], 0)
+
+    familiar = numpy.sum([contrasts[f'morph_{level}'] for level in ALL_MORPHS[ALL_MORPHS > morph_level]], 0)
+    not_familiar = numpy.sum([contrasts[f'morph_{level}'] for level in ALL_MORPHS[ALL_MORPHS < morph_level]], 0)
+
+    return {"familiar - not familiar" : familiar - not_familiar,
+            "familiar" : familiar,
+            "not familiar" : not_familiar}
+
+
+def _fit_subject(task):
+    from nilearn.glm.first_level import FirstLevelModel
+
+    volumes = []
+    mask = None
+    for filename, result_path, idx_times in task['runs']:
+        run = mri.MRI(filename, result_path)
+        try:
+            nii_data = run.cleaned
+        except Exception:
+            print('Denoising not working!...')
+            nii_data = run.preprocessed
+        volumes += [image.index_img(nii_data, idx_times)]
+        if mask is None:
+            mask = run.brain_mask
+
+    fmri_glm = FirstLevelModel(task['repetition_time'], mask_img=mask, smoothing_fwhm=task['smoothing_fwhm'])
+    with profiling.span('glm fit', sub=task['subject']):
+        fmri_glm = fmri_glm.fit(image.concat_imgs(volumes), design_matrices=task['design_matrix'])
+
+    tmp_file = task['output_file'] + '.%d.tmp' %os.getpid()
+    joblib.dump(fmri_glm, tmp_file)
+    os.replace(tmp_file, task['output_file'])
+    return task['subject'], task['output_file']
+
+
+class FirstLevel(object):
+
+    def __init__(self, database, store, output_path='nilearn/glm', repetition_time=REPETITION_TIME,
+                 smoothing_fwhm=6, drift_model='polynomial', drift_order=3, runs=range(0, 4), cache_size=4):
+        self.database = database
+        self.store = store
+        self.output_path = output_path
+        self.repetition_time = repetition_time
+        self.smoothing_fwhm = smoothing_fwhm
+        self.drift_model = drift_model
+        self.drift_order = drift_order
+        self.runs = runs
+        self._models = cache.LRUCache(cache_size)
+
+    def _get_subject_path(self, subject):
+        path = os.path.join(self.output_path, 'sub-%02d' %int(subject))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        return path
+
+    def get_design(self, subject):
+        from nilearn.glm.first_level import make_first_level_design_matrix
+
+        all_runs = self.database.get_func(subject, lazy=True)
+        offset = 0
+        runs = []
+        times = []
+        conditions = []
+        for run in self.runs:
+            run_labels = self.store.query(int(subject), run=run + 1, columns=['run time', 'morph level'])
+            run_times = numpy.asarray(run_labels['run time'])
+            idx_times = numpy.around(run_times / (1000*self.repetition_time)).astype(int)
+            times += [run_times / 1000 + offset]
+            conditions += [numpy.asarray(run_labels['morph level'])]
+            runs += [(all_runs[run].filename, all_runs[run].result_path, idx_times)]
+            offset += self.repetition_time * all_runs[run].nb_volumes
+            all_runs[run].clear_cache()
+
+        run_times = numpy.concatenate(times)
+        events = pandas.DataFrame(
+            {'trial_type': [f'morph_{level}' for level in numpy.concatenate(conditions)],
+             'onset': run_times,
+             'duration': 0.5}
+        )
+        design_matrix = make_first_level_design_matrix(run_times, events,
+                                      drift_model=self.drift_model, drift_order=self.drift_order)
+        return runs, design_matrix
+
+    def _get_key(self, subject, runs, design_matrix):
+        sources = []
+        for run in self.runs:
+            sources += self.database.get_func(subject, lazy=True)[run]._cleaned_dependencies
+        return cache.make_key(int(subject), [i[0] for i in runs], sources, list(design_matrix.columns),
+            design_matrix.values.tobytes(), self.repetition_time, self.smoothing_fwhm)
+
+    def _get_task(self, subject):
+        runs, design_matrix = self.get_design(subject)
+        key = self._get_key(subject, runs, design_matrix)
+        output_file = os.path.join(self._get_subject_path(subject), key + '.joblib')
+        return {'subject' : int(subject),
+                'runs' : runs,
+                'design_matrix' : design_matrix,
+                'repetition_time' : self.repetition_time,
+                'smoothing_fwhm' : self.smoothing_fwhm,
+                'output_file' : output_file}
+
+    def _get_nb_workers(self, tasks, n_jobs, memory_limit):
+        if n_jobs is None:
+            n_jobs = os.cpu_count()
+        if memory_limit is None or len(tasks) == 0:
+            return max(1, n_jobs)
+        # a worker holds the 4D run it is cleaning plus the concatenated float64 volumes
+        sizes = []
+        for task in tasks:
+            run = self.database.get_func(task['subject'], lazy=True)[self.runs[0]]
+            nb_voxels = numpy.prod(run.shape[:3])
+            nb_volumes = sum(len(i[2]) for i in task['runs'])
+            sizes += [8 * nb_voxels * (3 * run.nb_volumes + 2 * nb_volumes)]
+        return int(max(1, min(n_jobs, memory_limit // max(sizes))))
+
+    def _set_latest(self, subject, output_file):
+        # only points to models that have been written, so an interrupted fit keeps the previous one
+        filename = os.path.join(self._get_subject_path(subject), 'latest.json')
+        with open(filename + '.tmp', 'w') as f:
+            json.dump({'model' : os.path.basename(output_file)}, f)
+        os.replace(filename + '.tmp', filename)
+        self._models.pop(int(subject))
+
+    def fit(self, subjects, n_jobs=1, memory_limit=None, force=False):
+        tasks = [self._get_task(subject) for subject in subjects]
+        for task in tasks:
+            if not force and os.path.exists(task['output_file']):
+                self._set_latest(task['subject'], task['output_file'])
+        tasks = [task for task in tasks if force or not os.path.exists(task['output_file'])]
+
+        def collect(results):
+            for subject, output_file in results:
+                self._set_latest(subject, output_file)
+                print(f"Subject {subject} fitted")
+
+        nb_workers = self._get_nb_workers(tasks, n_jobs, memory_limit)
+        if nb_workers == 1:
+            collect(map(_fit_subject, tasks))
+        else:
+            with concurrent.futures.ProcessPoolExecutor(nb_workers) as executor:
+                collect(profiling.gather(executor.map(profiling.remote(_fit_subject), tasks)))
+
+    def get_model(self, subject):
+        model = self._models.get(int(subject))
+        if model is None:
+            with open(os.path.join(self._get_subject_path(subject), 'latest.json')) as f:
+                filename = json.load(f)['model']
+            model = joblib.load(os.path.join(self._get_subject_path(subject), filename))
+            self._models.set(int(subject), model)
+        return model
+
+    def get_design_matrix(self, subject):
+        return self.get_model(subject).design_matrices_[0]
+
+    def compute_contrast(self, subject, contrast, output_type='z_score'):
+        return self.get_model(subject).compute_contrast(contrast, output_type=output_type)
+
+    def compute_contrasts(self, subject, contrasts, output_type='z_score'):
+        if callable(contrasts):
+            contrasts = contrasts(self.get_design_matrix(subject))
+        return {contrast_id : self.compute_contrast(subject, contrast_val, output_type)
+                for contrast_id, contrast_val in contrasts.items()}
+
+
+def make_trial_regressors(onsets, frame_times, duration=0.5, hrf_model='glover'):
+    # one hrf-convolved regressor per trial, (time x trials)
+    from nilearn.glm.first_level import compute_regressor
+    regressors = numpy.zeros((len(frame_times), len(onsets)))
+    for count, onset in enumerate(onsets):
+        condition = numpy.array([[onset], [duration], [1.0]])
+        regressors[:, count] = compute_regressor(condition, hrf_model, frame_times)[0][:, 0]
+    return regressors
+
+
+def get_residual_operator(nuisance):
+    # projects onto the orthogonal of the nuisance regressors, shared by every trial model
+    return numpy.eye(len(nuisance)) - nuisance.dot(numpy.linalg.pinv(nuisance))
+
+
+def lsa(regressors, signals):
+    return numpy.linalg.pinv(regressors).dot(signals)
+
+
+def lss(regressors, signals):
+    # each trial is fitted against the sum of all the other trials, once the nuisance is projected out
+    # the two-regressor normal equations are solved for all trials and voxels at once
+    total = regressors.sum(axis=1)
+    others = total[:, None] - regressors
+    xx = numpy.sum(regressors**2, axis=0)
+    xo = numpy.sum(regressors * others, axis=0)
+    oo = numpy.sum(others**2, axis=0)
+    xy = regressors.T.dot(signals)
+    oy = total.dot(signals)[None, :] - xy
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        return (oo[:, None] * xy - xo[:, None] * oy) / (xx * oo - xo**2)[:, None]
+
+
+class TrialBetas(object):
+
+    def __init__(self, database, store, method='lss', repetition_time=REPETITION_TIME, duration=0.5,
+                 hrf_model='glover', drift_model='polynomial', drift_order=3, chunk_size=cleaning.CHUNK_SIZE):
+        assert method in ['lss', 'lsa']
+        self.database = database
+        self.store = store
+        self.method = method
+        self.repetition_time = repetition_time
+        self.duration = duration
+        self.hrf_model = hrf_model
+        self.drift_model = drift_model
+        self.drift_order = drift_order
+        self.chunk_size = chunk_size
+
+    def get_trials(self, subject, run):
+        return self.store.query(int(subject), run=run + 1,
+                                columns=['trial', 'run time', 'morph level', 'couple', 'response'])
+
+    def get_design(self, mri_run, onsets, nb_volumes):
+        from nilearn.glm.first_level import make_first_level_design_matrix
+        frame_times = numpy.arange(nb_volumes) * self.repetition_time
+        confounds = mri_run.confounds[mri_run.confound_columns]
+        nuisance = make_first_level_design_matrix(frame_times, drift_model=self.drift_model,
+            drift_order=self.drift_order, add_regs=confounds.values, add_reg_names=list(confounds.columns))
+        regressors = make_trial_regressors(onsets, frame_times, self.duration, self.hrf_model)
+        return regressors, nuisance.values
+
+    def _get_key(self, mri_run, onsets):
+        name = os.path.basename(mri_run.filename).split('.')[0]
+        dependencies = mri_run._cleaned_dependencies + mri_run._masked_dependencies
+        return name + '_' + cache.make_key('betas', self.method, list(onsets), self.repetition_time, self.duration,
+                                           self.hrf_model, self.drift_model, self.drift_order, *dependencies)
+
+    def fit_run(self, subject, run, force=False):
+        mri_run = self.database.get_func(subject, lazy=True)[run]
+        trials = self.get_trials(subject, run)
+        onsets = numpy.asarray(trials['run time']) / 1000
+        key = self._get_key(mri_run, onsets)
+
+        if force or key not in mri_run.timeseries_cache:
+            with profiling.span('trial betas', method=self.method, **mri_run.entities):
+                mask = numpy.asanyarray(mri_run.brain_mask.dataobj) > 0
+                signals = cleaning.load_masked(mri_run.preprocessed, mask)
+                regressors, nuisance = self.get_design(mri_run, onsets, signals.shape[0])
+                residuals = get_residual_operator(nuisance)
+                regressors = residuals.dot(regressors)
+                solve = lsa if self.method == 'lsa' else lss
+
+                betas = numpy.empty((len(onsets), signals.shape[1]), dtype=numpy.float32)
+                for start in range(0, signals.shape[1], self.chunk_size):
+                    chunk = slice(start, start + self.chunk_size)
+                    betas[:, chunk] = solve(regressors, residuals.dot(signals[:, chunk].astype(numpy.float64)))
+                mri_run.timeseries_cache.set(key, betas)
+
+        result = {name : numpy.asarray(values) for name, values in trials.items()}
+        result['betas'] = mri_run.timeseries_cache.get(key, mmap_mode='r')
+        return result
+
+    def fit(self, subjects, runs=range(0, 4), n_jobs=1, force=False):
+        keys = [(subject, run) for subject in subjects for run in runs]
+        with concurrent.futures.ThreadPoolExecutor(n_jobs) as executor:
+            results = executor.map(lambda key: self.fit_run(key[0], key[1], force), keys)
+            return dict(zip(keys, results))
+
+
+class GroupMap(object):
+
+    def __init__(self, mask_img=None):
+        self.mask_img = mask_img
+        self.count = 0
+        self._mask = None
+        self._mean = None
+        self._m2 = None
+        self.affine = None
+        self.shape = None
+
+    def _initialize(self, img):
+        self.affine = img.affine
+        self.shape = img.shape[:3]
+        if self.mask_img is None:
+            self._mask = numpy.ones(self.shape, dtype=bool)
+        else:
+            mask_img = image.load_img(self.mask_img)
+            if mask_img.shape[:3] != self.shape or not numpy.allclose(mask_img.affine, self.affine):
+                mask_img = image.resample_to_img(mask_img, img, interpolation='nearest')
+            self._mask = numpy.asanyarray(mask_img.dataobj) > 0
+        nb_voxels = int(self._mask.sum())
+        self._mean = numpy.zeros(nb_voxels)
+        self._m2 = numpy.zeros(nb_voxels)
+
+    def add(self, img):
+        img = image.load_img(img)
+        if self._mask is None:
+            self._initialize(img)
+        values = numpy.asanyarray(img.dataobj)[self._mask].astype(numpy.float64)
+        self.count += 1
+        delta = values - self._mean
+        self._mean += delta / self.count
+        self._m2 += delta * (values - self._mean)
+        return self
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.__dict__.update({key : (value.copy() if isinstance(value, numpy.ndarray) else value)
+                                  for key, value in other.__dict__.items()})
+            return self
+        count = self.count + other.count
+        delta = other._mean - self._mean
+        self._mean += delta * other.count / count
+        self._m2 += other._m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        return self
+
+    @property
+    def mean(self):
+        return self._mean
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return numpy.full(len(self._mean), numpy.nan)
+        return self._m2 / (self.count - 1)
+
+    @property
+    def t_values(self):
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            return self._mean / numpy.sqrt(self.variance / self.count)
+
+    @property
+    def z_values(self):
+        return _t_to_z(self.t_values, self.count - 1)
+
+    def to_img(self, values):
+        import nibabel
+        data = numpy.zeros(self.shape, dtype=numpy.float32)
+        data[self._mask] = numpy.nan_to_num(values)
+        return nibabel.Nifti1Image(data, self.affine)
+
+    @property
+    def mean_img(self):
+        return self.to_img(self._mean)
+
+    @property
+    def variance_img(self):
+        return self.to_img(self.variance)
+
+    @property
+    def t_img(self):
+        return self.to_img(self.t_values)
+
+    @property
+    def z_img(self):
+        return self.to_img(self.z_values)
+
+
+def _t_to_z(t_values, dof):
+    from scipy import stats
+    dof = numpy.broadcast_to(dof, numpy.shape(t_values))
+    with numpy.errstate(invalid='ignore'):
+        # use the smaller tail on each side to stay accurate for large |t|
+        z_values = stats.norm.isf(stats.t.sf(t_values, dof))
+        negative = t_values < 0
+        z_values[negative] = -stats.norm.isf(stats.t.cdf(t_values[negative], dof[negative]))
+    return z_values
+
+
+def two_sample(group_a, group_b):
+    # Welch t-test between two GroupMaps defined on the same grid
+    assert numpy.array_equal(group_a._mask, group_b._mask)
+    difference = group_a.mean - group_b.mean
+    var_a = group_a.variance / group_a.count
+    var_b = group_b.variance / group_b.count
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        t_values = difference / numpy.sqrt(var_a + var_b)
+        dof = (var_a + var_b)**2 / (var_a**2 / (group_a.count - 1) + var_b**2 / (group_b.count - 1))
+    return {'difference' : group_a.to_img(difference),
+            't' : group_a.to_img(t_values),
+            'z' : group_a.to_img(_t_to_z(t_values, dof))}
+
+
+class GroupMaps(dict):
+
+    def __init__(self, mask_img=None):
+        dict.__init__(self)
+        self.mask_img = mask_img
+
+    def add(self, contrast_id, img):
+        if contrast_id not in self:
+            self[contrast_id] = GroupMap(self.mask_img)
+        self[contrast_id].add(img)
+
+    def merge(self, other):
+        for contrast_id, group in other.items():
+            if contrast_id not in self:
+                self[contrast_id] = GroupMap(self.mask_img)
+            self[contrast_id].merge(group)
+        return self
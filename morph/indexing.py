@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+
+MAX_AGE = 10.0
+
+_lock = threading.Lock()
+_indices = {}
+
+
+def parse_entities(filename):
+    name = os.path.basename(filename)
+    stem, dot, extension = name.partition('.')
+    entities = {}
+    parts = stem.split('_')
+    for part in parts:
+        if '-' in part:
+            key, value = part.split('-', 1)
+            entities[key] = value
+    if len(parts) > 0 and '-' not in parts[-1]:
+        entities['suffix'] = parts[-1]
+    entities['extension'] = dot + extension
+    return entities
+
+
+class DirectoryIndex(object):
+
+    def __init__(self, path, max_age=MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        files = []
+        entities = {}
+        by_entity = {}
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+            with os.scandir(self.path) as it:
+                for entry in it:
+                    files += [entry.name]
+        except FileNotFoundError:
+            mtime = None
+
+        for name in files:
+            entities[name] = parse_entities(name)
+            for item in entities[name].items():
+                by_entity.setdefault(item, []).append(name)
+
+        with self._lock:
+            self._mtime = mtime
+            self._checked = time.monotonic()
+            self._files = files
+            self._entities = entities
+            self._by_entity = by_entity
+            self._found = {}
+
+    @property
+    def is_stale(self):
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime
+        except FileNotFoundError:
+            return self._mtime is not None
+
+    def _check(self):
+        if self.max_age is None:
+            return
+        if time.monotonic() - self._checked > self.max_age:
+            if self.is_stale:
+                self.refresh()
+            else:
+                self._checked = time.monotonic()
+
+    @property
+    def files(self):
+        self._check()
+        return list(self._files)
+
+    def _is_compatible(self, name, entities):
+        for key, value in entities.items():
+            if key in self._entities[name] and self._entities[name][key] != value:
+                return False
+        return True
+
+    def find(self, pattern, **entities):
+        self._check()
+        key = (pattern, tuple(sorted(entities.items())))
+        if key not in self._found:
+            result = None
+            for name in self._files:
+                if name.find(pattern) > -1 and self._is_compatible(name, entities):
+                    result = os.path.join(self.path, name)
+                    break
+            self._found[key] = result
+        return self._found[key]
+
+    def get(self, **entities):
+        self._check()
+        names = None
+        for item in entities.items():
+            matches = self._by_entity.get(item, [])
+            if names is None:
+                names = matches
+            else:
+                matches = set(matches)
+                names = [name for name in names if name in matches]
+        if names is None:
+            names = self._files
+        return [os.path.join(self.path, name) for name in names]
+
+
+def get_index(path, max_age=MAX_AGE):
+    path = os.path.abspath(path)
+    with _lock:
+        if path not in _indices:
+            _indices[path] = DirectoryIndex(path, max_age)
+        return _indices[path]
+
+
+def refresh(path=None):
+    with _lock:
+        indices = list(_indices.values())
+    for index in indices:
+        if path is None or index.path == os.path.abspath(path):
+            index.refresh()
+
+
+class LayoutIndex(object):
+
+    def __init__(self, root, index_file=None, reset=False):
+        self.root = os.path.abspath(root)
+        if index_file is None:
+            index_file = os.path.join(os.path.dirname(self.root), 'layout.json')
+        self.index_file = index_file
+        self._subjects = {}
+        if not reset and os.path.exists(self.index_file):
+            import json
+            with open(self.index_file) as f:
+                self._subjects = json.load(f)['subjects']
+        self.update()
+
+    def _is_changed(self, name):
+        # adding or removing an entry changes the mtime of its directory, so the directories recorded at
+        # the last scan are enough to tell whether a subject has to be listed again
+        if name not in self._subjects:
+            return True
+        for relative_path, mtime in self._subjects[name]['directories'].items():
+            try:
+                if os.stat(os.path.join(self.root, relative_path)).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def _scan_subject(self, name):
+        files = []
+        directories = {}
+        for root, dirs, filenames in os.walk(os.path.join(self.root, name)):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            directories[os.path.relpath(root, self.root)] = os.stat(root).st_mtime_ns
+            files += [os.path.relpath(os.path.join(root, f), self.root) for f in filenames if not f.startswith('.')]
+        return {'directories' : directories, 'files' : sorted(files)}
+
+    def update(self):
+        names = sorted(entry.name for entry in os.scandir(self.root)
+                       if entry.is_dir() and entry.name.startswith('sub-'))
+        changed = False
+        for name in list(self._subjects):
+            if name not in names:
+                del self._subjects[name]
+                changed = True
+        for name in names:
+            if self._is_changed(name):
+                self._subjects[name] = self._scan_subject(name)
+                changed = True
+        if changed:
+            self.save()
+        self._build_table()
+        return changed
+
+    def save(self):
+        import json
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'root' : self.root, 'subjects' : self._subjects}, f)
+        os.replace(tmp_file, self.index_file)
+
+    def _build_table(self):
+        # subject -> datatype -> filenames
+        self._entities = {}
+        self._table = {}
+        for name, subject in self._subjects.items():
+            datatypes = self._table.setdefault(name[len('sub-'):], {})
+            for relative_path in subject['files']:
+                entities = parse_entities(relative_path)
+                entities['subject'] = name[len('sub-'):]
+                parent = os.path.basename(os.path.dirname(relative_path))
+                entities['datatype'] = None if parent.startswith(('sub-', 'ses-')) else parent
+                filename = os.path.join(self.root, relative_path)
+                self._entities[filename] = entities
+                datatypes.setdefault(entities['datatype'], []).append(filename)
+
+    def get(self, subject=None, datatype=None, extension=None, **entities):
+        if extension is not None and not extension.startswith('.'):
+            extension = '.' + extension
+        if subject is not None:
+            tables = [self._table.get(str(subject), {})]
+        else:
+            tables = self._table.values()
+        results = []
+        for datatypes in tables:
+            if datatype is not None:
+                groups = [datatypes.get(datatype, [])]
+            else:
+                groups = datatypes.values()
+            for filenames in groups:
+                for filename in filenames:
+                    file_entities = self._entities[filename]
+                    if extension is not None and file_entities['extension'] != extension:
+                        continue
+                    if any(str(file_entities.get(name)) != str(value) for name, value in entities.items()
+                           if value is not None):
+                        continue
+                    results += [filename]
+        return sorted(results)
+
+    def get_subjects(self, datatype=None):
+        return sorted(set(self._entities[filename]['subject'] for filename in self.get(datatype=datatype)))
@@ -1,18 +1,34 @@
 import os
-import sys
 import nibabel
 import numpy
 import nilearn
 import nilearn.plotting
-from nilearn.input_data import NiftiMasker
-from nilearn.input_data import NiftiLabelsMasker, NiftiMapsMasker
 from nilearn import image
-from nilearn import datasets
 import pylab as plt
+import cache
+import atlases
+import indexing
+import profiling
+import cleaning
+
+CACHE_SIZE = 8
+CACHE_PATH = None
+CACHE_DISK_SIZE = 50 * 1024**3
+TIMESERIES_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'morph', 'timeseries')
+TIMESERIES_DISK_SIZE = 50 * 1024**3
+ATLAS_NAME = 'cort-maxprob-thr25-2mm'
+ATLAS_FAMILY = 'harvard_oxford'
+# uncompressed copies of the .nii.gz inputs that nibabel can memory-map, disabled when None
+MIRROR_PATH = None
+MIRROR_DISK_SIZE = 50 * 1024**3
+CLEAN_CHUNKED = True
+CLEAN_MEMORY_LIMIT = None
+CLEAN_N_JOBS = 1
+CLEAN_TEMP_PATH = None
 
 class MRI(object):
 
-    def __init__(self, filename, result_path):
+    def __init__(self, filename, result_path, cache_size=None, cache_path=None):
 
         self.data_path = os.path.dirname(filename)
         self.filename = filename
@@ -20,33 +36,52 @@ class MRI(object):
         assert os.path.exists(self.filename)
         self._nifti_filename = None
         self._data = None
+        self._mirror = None
         self._brain_mask = None
         self._mask_indices = None
+        self._spatial_index = None
+        self._entities = None
+        if cache_size is None:
+            cache_size = CACHE_SIZE
+        if cache_path is None:
+            cache_path = CACHE_PATH
+        self._cache = cache.LRUCache(cache_size)
+        self._disk_cache = None
+        if cache_path is not None:
+            self._disk_cache = cache.DiskCache(cache_path, CACHE_DISK_SIZE)
         self._low_pass = 0.08
         self._high_pass = 0.009
         self._t_r = self.data.header.get_zooms()[3]
         self.confound_columns = ['a_comp_cor_00', 'a_comp_cor_01', 'a_comp_cor_02', 'a_comp_cor_03', 'a_comp_cor_04', 
         'a_comp_cor_05', 'cosine00', 'cosine01', 'cosine02', 'cosine03', 'cosine04', 'cosine05', 'trans_x', 
         'trans_y', 'trans_z', 'rot_x', 'rot_y', 'rot_z']
-        if self.is_preprocessed:
-            self._masker = NiftiMasker(mask_img=self.brain_mask, standardize=True, mask_strategy='epi')
+        self.atlas_name = ATLAS_NAME
+        self.atlas_family = ATLAS_FAMILY
+        self._timeseries_cache = None
+        self._keys = {}
+
+    @property
+    def dataset(self):
+        return atlases.get_atlas(self.atlas_name, self.atlas_family)
 
-            # self.dataset = datasets.fetch_atlas_msdl()
-            # self.labels = self.dataset.labels
-            # self.atlas_filename = self.dataset.maps
-            # self._parcelizer = NiftiMapsMasker(maps_img=self.atlas_filename, standardize=True,
-            #                    memory='nilearn_cache', verbose=5, mask_img=self.brain_mask)
+    @property
+    def atlas_filename(self):
+        return self.dataset.filename
 
-            self.dataset = datasets.fetch_atlas_harvard_oxford('cort-maxprob-thr25-2mm')
-            self.atlas_filename = self.dataset.filename
-            self.labels = self.dataset.labels[1:]
-            
-            #self.dataset = datasets.fetch_atlas_juelich('maxprob-thr25-2mm')
-            #self.labels = self.dataset.labels
+    @property
+    def labels(self):
+        if self.atlas_family == 'harvard_oxford':
+            return self.dataset.labels[1:]
+        return self.dataset.labels
+
+    @property
+    def _masker(self):
+        return atlases.get_masker(self.brain_mask)
+
+    @property
+    def _parcelizer(self):
+        return atlases.get_parcelizer(self.atlas_name, self.brain_mask, self.atlas_family)
 
-            self._parcelizer = NiftiLabelsMasker(labels_img=self.atlas_filename, standardize=True,
-                               memory='nilearn_cache', verbose=5, mask_img=self.brain_mask)
-            
     @property
     def duration(self):
         return self.data.shape[-1]
@@ -58,29 +93,98 @@ class MRI(object):
     @property
     def data(self):
         if self._data is None:
-            self._data = nibabel.load(self.filename)
+            # only the header is needed here, so an existing mirror is used but none is created
+            if self.mirror is not None:
+                self._data = self.mirror.load(self.filename, create=False)
+            else:
+                self._data = nibabel.load(self.filename)
         return self._data
 
+    @property
+    def entities(self):
+        if self._entities is None:
+            entities = indexing.parse_entities(self.filename)
+            self._entities = {key : entities[key] for key in ['sub', 'ses', 'task', 'run'] if key in entities}
+        return dict(self._entities)
+
+    @property
+    def index(self):
+        return indexing.get_index(self.result_path)
+
     def _get_file(self, pattern):
-        files = os.listdir(self.result_path)
-        for file in files:
-            if file.find(pattern) > -1:
-                return os.path.join(self.result_path, file)
+        return self.index.find(pattern, **self.entities)
 
     @property
     def is_preprocessed(self):
-        files = os.listdir(self.result_path)    
-        for file in files:
-            if file.find('MNI152') > -1:
-                return True
+        if self.index.find('MNI152') is not None:
+            return True
         print("Files should be preprocessed via fmriprep first!")
         return False
 
+    @property
+    def filter_parameters(self):
+        return (self._low_pass, self._high_pass, tuple(self.confound_columns), float(self._t_r))
+
+    def _get_cached(self, name, dependencies, compute, from_disk=None):
+        key = cache.make_key(name, *dependencies)
+        self._keys[name] = key
+        value = self._cache.get(key)
+        if value is not None:
+            if profiling.ENABLED:
+                profiling.count('memory cache hit', stage=name, **self.entities)
+            return value
+
+        if from_disk and self._disk_cache is not None:
+            value = self._disk_cache.get(key)
+            if value is not None:
+                if profiling.ENABLED:
+                    profiling.count('disk cache hit', stage=name, **self.entities)
+                value = from_disk(value)
+                self._cache.set(key, value)
+                return value
+
+        if profiling.ENABLED:
+            profiling.count('cache miss', stage=name, **self.entities)
+        with profiling.span(name, **self.entities):
+            value = compute()
+        self._cache.set(key, value)
+        if from_disk and self._disk_cache is not None:
+            if isinstance(value, nibabel.spatialimages.SpatialImage):
+                self._disk_cache.set(key, numpy.asanyarray(value.dataobj))
+            else:
+                self._disk_cache.set(key, value)
+        return value
+
+    def preload(self, name='preprocessed'):
+        # reads a lazily loaded image into memory so that later accesses do not touch the disk
+        value = getattr(self, name)
+        # memory-mapped images (mirrors, out of core cleaning) are copied, a view would not read anything
+        if isinstance(value, nibabel.spatialimages.SpatialImage) and (not value.in_memory
+                                                                     or isinstance(value.dataobj, numpy.memmap)):
+            with profiling.span('preload', stage=name, **self.entities):
+                value = nibabel.Nifti1Image(numpy.array(value.dataobj), value.affine, value.header)
+            self._cache.set(self._keys[name], value)
+        return value
+
+    @property
+    def nbytes(self):
+        return int(numpy.prod(self.shape)) * 4
+
+    def _as_image(self, reference):
+        return lambda data: nibabel.Nifti1Image(data, reference.affine, reference.header)
+
+    def clear_cache(self, disk=False):
+        self._cache.clear()
+        if disk and self._disk_cache is not None:
+            self._disk_cache.clear()
+
     @property
     def confounds(self):
         import pandas as pd
         if self.is_preprocessed:
-            return pd.read_csv(self._get_file('desc-confounds_timeseries.tsv'), delimiter='\t')
+            filename = self._get_file('desc-confounds_timeseries.tsv')
+            return self._get_cached('confounds', [cache.file_signature(filename)],
+                lambda: pd.read_csv(filename, delimiter='\t'))
         else:
             return None
 
@@ -106,18 +210,35 @@ class MRI(object):
         else:
             return None
 
+    @property
+    def mirror(self):
+        if self._mirror is None and MIRROR_PATH is not None:
+            self._mirror = cache.NiftiMirror(MIRROR_PATH, MIRROR_DISK_SIZE)
+        return self._mirror
+
+    def _load(self, filename):
+        # compressed images are read through their uncompressed mirror, which nibabel memory-maps
+        if self.mirror is not None:
+            return self.mirror.load(filename)
+        return nibabel.load(filename)
+
     @property
     def nifti_filename(self):
         if self._nifti_filename is None:
-            self._nifti_filename = os.path.splitext(self.filename)[0]
-            nibabel.save(self.data, self._nifti_filename)
+            if self.mirror is not None:
+                self._nifti_filename = self.mirror.get(self.filename)
+                if self._nifti_filename != self.filename:
+                    self.mirror.pin(self._nifti_filename)
+            else:
+                self._nifti_filename = os.path.splitext(self.filename)[0]
+                nibabel.save(self.data, self._nifti_filename)
         return self._nifti_filename
 
     @property
     def brain_mask(self):
         if self.is_preprocessed:
             if self._brain_mask is None:
-                self._brain_mask = nibabel.load(self._get_file('brain_mask.nii.gz'))
+                self._brain_mask = self._load(self._get_file('brain_mask.nii.gz'))
             return self._brain_mask
         else:
             return None
@@ -128,39 +249,75 @@ class MRI(object):
             self._mask_indices = numpy.where(self.brain_mask.get_fdata() > 0)
         return self._mask_indices
 
+    @property
+    def preprocessed_filename(self):
+        return self._get_file('preproc_bold.nii.gz')
+
     @property
     def preprocessed(self):
         if self.is_preprocessed:
-            return nibabel.load(self._get_file('preproc_bold.nii.gz'))
+            filename = self.preprocessed_filename
+            return self._get_cached('preprocessed', [cache.file_signature(filename)],
+                lambda: self._load(filename))
         else:
             return None
 
+    @property
+    def _cleaned_dependencies(self):
+        return [cache.file_signature(self.preprocessed_filename),
+                cache.file_signature(self._get_file('desc-confounds_timeseries.tsv')),
+                self.filter_parameters]
+
+    @property
+    def _masked_dependencies(self):
+        return [cache.file_signature(self._get_file('brain_mask.nii.gz'))]
+
     @property
     def cleaned(self):
         if self.is_preprocessed:
-            confound_matrix = self.confounds[self.confound_columns].values
-            return image.clean_img(self.preprocessed, confounds=confound_matrix, 
-                detrend=True, low_pass=self._low_pass, high_pass=self._high_pass, t_r=self._t_r)
+            def compute():
+                confound_matrix = self.confounds[self.confound_columns].values
+                if CLEAN_CHUNKED:
+                    return cleaning.clean_img(self.preprocessed, confounds=confound_matrix,
+                        detrend=True, low_pass=self._low_pass, high_pass=self._high_pass, t_r=self._t_r,
+                        mask_img=self.brain_mask, memory_limit=CLEAN_MEMORY_LIMIT, n_jobs=CLEAN_N_JOBS,
+                        temp_dir=CLEAN_TEMP_PATH)
+                return image.clean_img(self.preprocessed, confounds=confound_matrix, 
+                    detrend=True, low_pass=self._low_pass, high_pass=self._high_pass, t_r=self._t_r,
+                    mask_img=self.brain_mask)
+            # voxels outside of the brain mask are left to zero
+            return self._get_cached('cleaned', self._cleaned_dependencies + self._masked_dependencies, compute,
+                from_disk=self._as_image(self.preprocessed))
         else:
             return None
 
     @property
     def masked_normalized_values(self):
-        return self._masker.fit_transform(self.preprocessed)
+        dependencies = [cache.file_signature(self.preprocessed_filename)] + self._masked_dependencies
+        return self._get_cached('masked_normalized', dependencies,
+            lambda: self._masker.fit_transform(self.preprocessed), from_disk=numpy.asarray)
 
     @property
     def masked_normalized_cleaned_values(self):
-        return self._masker.fit_transform(self.cleaned)
+        dependencies = self._cleaned_dependencies + self._masked_dependencies
+        return self._get_cached('masked_normalized_cleaned', dependencies,
+            lambda: self._masker.fit_transform(self.cleaned), from_disk=numpy.asarray)
 
     @property
     def masked_normalized_cleaned_parceled_values(self):
-        return self._parcelizer.fit_transform(self.cleaned)
+        dependencies = self._cleaned_dependencies + self._masked_dependencies + [self.atlas_family, self.atlas_name]
+        return self._get_cached('masked_normalized_cleaned_parceled', dependencies,
+            lambda: self._parcelizer.fit_transform(self.cleaned), from_disk=numpy.asarray)
 
     def clean_nifti(self):
         if self._nifti_filename is not None:
-            if os.path.exists(self._nifti_filename):
+            if self.mirror is not None:
+                # the mirror is shared with the other instances of the run, it is left to the LRU eviction
+                if self._nifti_filename != self.filename:
+                    self.mirror.unpin(self._nifti_filename)
+            elif os.path.exists(self._nifti_filename):
                 os.remove(self._nifti_filename)
-                self._nifti_filename = None
+            self._nifti_filename = None
 
     def export(self, output_file, parcellation=True, compression=True):
         if not parcellation:
@@ -174,19 +331,65 @@ class MRI(object):
             else:
                 numpy.savez_compressed(output_file, self.masked_normalized_cleaned_values, self.masked_normalized_cleaned_parceled_values)
 
-    def get_selection_voxels(self, position, radius=10, mask=None):
-
-        if mask is None:
-            x, y, z = self.mask_indices
+    @property
+    def timeseries_cache(self):
+        if self._timeseries_cache is None:
+            # kept out of the derivatives, entries are keyed on the run name and the signatures of its sources
+            self._timeseries_cache = cache.DiskCache(TIMESERIES_PATH, TIMESERIES_DISK_SIZE)
+        return self._timeseries_cache
+
+    def _get_timeseries_key(self, cleaned=True):
+        name = os.path.basename(self.filename).split('.')[0]
+        if cleaned:
+            dependencies = self._cleaned_dependencies + self._masked_dependencies
         else:
-            x, y, z = mask
+            dependencies = [cache.file_signature(self.preprocessed_filename)] + self._masked_dependencies
+        return name + '_' + cache.make_key('timeseries', cleaned, *dependencies)
+
+    def export_timeseries(self, cleaned=True, force=False):
+        key = self._get_timeseries_key(cleaned)
+        mask_key = 'mask_' + atlases.image_key(self.brain_mask)
+        if force or key not in self.timeseries_cache:
+            if cleaned:
+                values = self.masked_normalized_cleaned_values
+            else:
+                values = self.masked_normalized_values
+            with profiling.span('export timeseries', **self.entities):
+                self.timeseries_cache.set(key, numpy.asarray(values, dtype=numpy.float32))
+        if mask_key not in self.timeseries_cache:
+            flat_indices = numpy.ravel_multi_index(self.mask_indices, self.brain_mask.shape[:3])
+            self.timeseries_cache.set(mask_key, flat_indices.astype(numpy.int32))
+        return key
+
+    def get_timeseries(self, volumes=None, voxels=None, cleaned=True):
+        # memory-mapped (time x voxels) float32 array, slices are views on the file
+        key = self.export_timeseries(cleaned)
+        data = self.timeseries_cache.get(key, mmap_mode='r')
+        if volumes is not None:
+            data = data[volumes]
+        if voxels is not None:
+            data = data[:, voxels]
+        return data
+
+    @property
+    def timeseries_indices(self):
+        self.export_timeseries()
+        flat_indices = self.timeseries_cache.get('mask_' + atlases.image_key(self.brain_mask), mmap_mode='r')
+        return numpy.unravel_index(flat_indices, self.brain_mask.shape[:3])
+
+    def get_spatial_index(self, mask=None):
+        # the brain mask shares the grid of the run, its affine avoids loading the 4D data
+        if mask is not None:
+            return atlases.get_spatial_index(mask, self.brain_mask.affine)
+        if self._spatial_index is None:
+            self._spatial_index = atlases.get_mask_spatial_index(self.brain_mask)
+        return self._spatial_index
 
-        coordinates = numpy.array(image.coord_transform(x, y, z, self.preprocessed.affine))
-        coordinates = numpy.unique(coordinates, axis=1)
-        distances = numpy.linalg.norm(numpy.array(coordinates).T - position, axis=1)
-        idx = numpy.where(distances < radius)[0]
+    def get_selection_voxels(self, position, radius=10, mask=None):
+        return self.get_spatial_index(mask).query(position, radius)
 
-        return coordinates[:, idx], idx, distances[idx]
+    def get_selection_voxels_batch(self, positions, radius=10, mask=None):
+        return self.get_spatial_index(mask).query_many(positions, radius)
 
     def get_correlation_matrix(self, kind='correlation', time_series=None):
 
@@ -260,10 +463,7 @@ class ANAT(MRI):
         self.session_path = path
 
     def _get_session_file(self, pattern):
-        files = os.listdir(self.session_path)
-        for file in files:
-            if file.find(pattern) > -1:
-                return os.path.join(self.session_path, file)
+        return indexing.get_index(self.session_path).find(pattern)
 
     @property
     def local_transformation(self):
@@ -273,8 +473,5 @@ class ANAT(MRI):
             return None
 
     @property
-    def preprocessed(self):
-        if self.is_preprocessed:
-            return nibabel.load(self._get_file('preproc_T1w.nii.gz'))
-        else:
-            return None
+    def preprocessed_filename(self):
+        return self._get_file('preproc_T1w.nii.gz')
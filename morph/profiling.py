@@ -0,0 +1,205 @@
+import os
+import csv
+import json
+import time
+import atexit
+import threading
+import contextlib
+import collections
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ENABLED = os.environ.get('MORPH_PROFILE', '') not in ['', '0']
+OUTPUT = os.environ.get('MORPH_PROFILE_OUTPUT')
+
+_lock = threading.Lock()
+_events = []
+_counters = collections.defaultdict(float)
+_origin = time.perf_counter()
+_null = contextlib.nullcontext()
+
+
+def peak_rss():
+    # peak resident set size of the process in bytes
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    with _lock:
+        del _events[:]
+        _counters.clear()
+
+
+@contextlib.contextmanager
+def _span(name, attributes):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        event = {'name' : name,
+                 'start' : start - _origin,
+                 'duration' : end - start,
+                 'pid' : os.getpid(),
+                 'tid' : threading.get_ident(),
+                 'peak_rss' : peak_rss(),
+                 'args' : attributes}
+        with _lock:
+            _events.append(event)
+
+
+def span(name, **attributes):
+    if not ENABLED:
+        return _null
+    return _span(name, attributes)
+
+
+def count(name, value=1, **attributes):
+    if not ENABLED:
+        return
+    key = (name,) + tuple(sorted(attributes.items()))
+    with _lock:
+        _counters[key] += value
+
+
+class _Remote(object):
+
+    def __init__(self, function):
+        self.function = function
+        self.enabled = ENABLED
+        self.pid = os.getpid()
+
+    def __call__(self, *args, **kwargs):
+        if not self.enabled or os.getpid() == self.pid:
+            return self.function(*args, **kwargs), None
+        # pool workers leave with os._exit and never run atexit, their events go back with the result
+        enable()
+        reset()
+        try:
+            result = self.function(*args, **kwargs)
+        finally:
+            events, counters = get_events(), get_counters()
+            reset()
+        return result, {'events' : events, 'counters' : counters, 'origin' : _origin}
+
+
+def remote(function):
+    # wraps a function run in worker processes, results come back as (result, events) for gather
+    return _Remote(function)
+
+
+def merge(profile):
+    if profile is None:
+        return
+    # start times are relative to the clock origin of the worker, perf_counter is shared across processes
+    offset = profile['origin'] - _origin
+    with _lock:
+        for event in profile['events']:
+            _events.append(dict(event, start=event['start'] + offset))
+        for counter in profile['counters']:
+            counter = dict(counter)
+            name, value = counter.pop('name'), counter.pop('value')
+            _counters[(name,) + tuple(sorted(counter.items()))] += value
+
+
+def gather(results):
+    for result, profile in results:
+        merge(profile)
+        yield result
+
+
+def get_events():
+    with _lock:
+        return list(_events)
+
+
+def get_counters():
+    with _lock:
+        return [dict(key[1:], name=key[0], value=value) for key, value in _counters.items()]
+
+
+def summary():
+    stages = collections.OrderedDict()
+    with _lock:
+        for event in _events:
+            stage = stages.setdefault(event['name'], {'name' : event['name'], 'count' : 0, 'total' : 0.0,
+                                                      'max' : 0.0, 'peak_rss' : 0})
+            stage['count'] += 1
+            stage['total'] += event['duration']
+            stage['max'] = max(stage['max'], event['duration'])
+            stage['peak_rss'] = max(stage['peak_rss'], event['peak_rss'] or 0)
+    for stage in stages.values():
+        stage['mean'] = stage['total'] / stage['count']
+    return sorted(stages.values(), key=lambda stage: stage['total'], reverse=True)
+
+
+def export_json(filename):
+    data = {'events' : get_events()}
+    data['counters'] = get_counters()
+    data['summary'] = summary()
+    data['peak_rss'] = peak_rss()
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=2, default=str)
+
+
+def export_csv(filename):
+    keys = ['name', 'start', 'duration', 'pid', 'tid', 'peak_rss']
+    events = get_events()
+    attributes = sorted(set(key for event in events for key in event['args']))
+    with open(filename, 'w', newline='') as f:
+        writer = csv.DictWriter(f, keys + attributes)
+        writer.writeheader()
+        for event in events:
+            row = {key : event[key] for key in keys}
+            row.update(event['args'])
+            writer.writerow(row)
+
+
+def export_chrome_trace(filename):
+    # loadable in chrome://tracing or https://ui.perfetto.dev
+    trace = []
+    events = get_events()
+    for event in events:
+        trace += [{'name' : event['name'], 'ph' : 'X', 'pid' : event['pid'], 'tid' : event['tid'],
+                   'ts' : event['start'] * 1e6, 'dur' : event['duration'] * 1e6,
+                   'args' : dict(event['args'], peak_rss=event['peak_rss'])}]
+    now = (time.perf_counter() - _origin) * 1e6
+    for counter in get_counters():
+        value = counter.pop('value')
+        name = ' '.join([counter.pop('name')] + ['%s-%s' %item for item in sorted(counter.items())])
+        trace += [{'name' : name, 'ph' : 'C', 'pid' : os.getpid(), 'ts' : now, 'args' : {'value' : value}}]
+    with open(filename, 'w') as f:
+        json.dump({'traceEvents' : trace, 'displayTimeUnit' : 'ms'}, f, default=str)
+
+
+def export(prefix):
+    directory = os.path.dirname(os.path.abspath(prefix))
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    export_json(prefix + '.json')
+    export_csv(prefix + '.csv')
+    export_chrome_trace(prefix + '.trace.json')
+
+
+def _export_at_exit():
+    if len(_events) > 0 or len(_counters) > 0:
+        export('%s.%d' %(OUTPUT, os.getpid()))
+
+
+if ENABLED and OUTPUT:
+    atexit.register(_export_at_exit)
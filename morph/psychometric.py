@@ -0,0 +1,190 @@
+import warnings
+import concurrent.futures
+import numpy
+from scipy.optimize import curve_fit
+import behavior
+
+MORPH_LEVELS = numpy.linspace(5, 95, 10)
+PARAMETERS = ['L', 'x0', 'k', 'b']
+
+sigmoid = behavior.sigmoid
+
+
+def jacobian(x, L, x0, k, b):
+    with numpy.errstate(over='ignore'):
+        s = 1 / (1 + numpy.exp(-k*(x-x0)))
+    ds = s * (1 - s)
+    return numpy.stack([s, -L*k*ds, L*(x-x0)*ds, numpy.ones_like(s)], axis=-1)
+
+
+def initial_guess(ydata, xdata=MORPH_LEVELS):
+    return [max(ydata), numpy.median(xdata), 1, min(ydata)]
+
+
+def fit_curve(ydata, xdata=MORPH_LEVELS, p0=None, maxfev=5000, jac=None):
+    if p0 is None:
+        p0 = initial_guess(ydata, xdata)
+    ydata = numpy.asarray(ydata, dtype=numpy.float64)
+    if len(ydata) != len(xdata) or numpy.any(numpy.isnan(ydata)):
+        return numpy.full(4, numpy.nan), False
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            popt, pcov = curve_fit(sigmoid, xdata, ydata, p0, jac=jac, maxfev=maxfev)
+    except Exception:
+        return numpy.full(4, numpy.nan), False
+    return popt, True
+
+
+def fit_batch(curves, xdata=MORPH_LEVELS, p0=None, max_iter=500, tol=1e-10):
+    # Levenberg-Marquardt run on all curves at once with the analytic jacobian
+    curves = numpy.atleast_2d(numpy.asarray(curves, dtype=numpy.float64))
+    valid = ~numpy.any(numpy.isnan(curves), axis=1)
+    y = numpy.where(valid[:, None], curves, 0)
+    x = numpy.asarray(xdata, dtype=numpy.float64)[None, :]
+    if p0 is None:
+        p0 = numpy.stack([y.max(axis=1), numpy.full(len(y), numpy.median(xdata)),
+                          numpy.ones(len(y)), y.min(axis=1)], axis=1)
+    popt = numpy.array(p0, dtype=numpy.float64)
+    damping = numpy.full(len(y), 1e-3, dtype=numpy.float64)
+    active = valid.copy()
+    eye = numpy.eye(4)
+
+    def cost(p, rows):
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            return numpy.sum((sigmoid(x, *p.T[:, :, None]) - y[rows])**2, axis=1)
+
+    current = cost(popt, slice(None))
+    for iteration in range(max_iter):
+        if not numpy.any(active):
+            break
+        p = popt[active]
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            residuals = sigmoid(x, *p.T[:, :, None]) - y[active]
+            J = jacobian(x, *p.T[:, :, None])
+        A = numpy.einsum('nti,ntj->nij', J, J)
+        g = numpy.einsum('nti,nt->ni', J, residuals)
+        scale = damping[active][:, None, None] * (A * eye + 1e-9 * eye)
+        with numpy.errstate(over='ignore', invalid='ignore'):
+            try:
+                step = numpy.linalg.solve(A + scale, -g[..., None])[..., 0]
+            except numpy.linalg.LinAlgError:
+                step = numpy.einsum('nij,nj->ni', numpy.linalg.pinv(A + scale), -g)
+        candidate = p + step
+        indices = numpy.where(active)[0]
+        new = cost(numpy.where(numpy.isfinite(candidate), candidate, p), indices)
+        improved = new < current[indices]
+
+        change = (current[indices] - new) / numpy.maximum(current[indices], 1e-300)
+        popt[indices[improved]] = candidate[improved]
+        current[indices[improved]] = new[improved]
+        damping[indices[improved]] /= 10
+        damping[indices[~improved]] *= 10
+        converged = (improved & (change < tol)) | (damping[indices] > 1e12)
+        active[indices[converged]] = False
+
+    success = valid & numpy.all(numpy.isfinite(popt), axis=1)
+    popt[~success] = numpy.nan
+    return popt, success
+
+
+def _fit_chunk(args):
+    curves, xdata, maxfev, jac = args
+    popt = numpy.full((len(curves), 4), numpy.nan)
+    success = numpy.zeros(len(curves), dtype=bool)
+    for count, ydata in enumerate(curves):
+        popt[count], success[count] = fit_curve(ydata, xdata, maxfev=maxfev, jac=jac)
+    return popt, success
+
+
+def _map_chunks(curves, xdata, maxfev, jac, n_jobs):
+    if n_jobs == 1 or len(curves) < 2:
+        return _fit_chunk((curves, xdata, maxfev, jac))
+    chunks = numpy.array_split(curves, min(len(curves), 4 * (n_jobs or 8)))
+    with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+        results = list(executor.map(_fit_chunk, [(chunk, xdata, maxfev, jac) for chunk in chunks]))
+    return numpy.concatenate([i[0] for i in results]), numpy.concatenate([i[1] for i in results])
+
+
+def fit_curves(curves, xdata=MORPH_LEVELS, maxfev=5000, jac=None, n_jobs=1):
+    curves = numpy.atleast_2d(numpy.asarray(curves, dtype=numpy.float64))
+    xdata = numpy.asarray(xdata, dtype=numpy.float64)
+    popt, success = _map_chunks(curves, xdata, maxfev, jac, n_jobs)
+    with numpy.errstate(over='ignore', invalid='ignore'):
+        fitted = sigmoid(xdata[None, :], *[popt[:, [i]] for i in range(4)])
+        rss = numpy.sum((curves - fitted)**2, axis=1)
+        tss = numpy.sum((curves - curves.mean(axis=1, keepdims=True))**2, axis=1)
+        r2 = 1 - rss / tss
+    return {'popt' : popt, 'success' : success, 'rss' : rss, 'r2' : r2}
+
+
+def get_curves(store, by=('subject',), subjects=None, run=None, exclude_couples=False):
+    excluded = False if exclude_couples else None
+    data = behavior.aggregate(store.query(subjects, run=run, excluded=excluded),
+        by=tuple(by) + ('morph level',), values=('response',))
+    keys, inverse = behavior._group(data, by)
+    levels = numpy.unique(data['morph level'])
+    curves = numpy.full((len(keys[by[0]]), len(levels)), numpy.nan)
+    curves[inverse, numpy.searchsorted(levels, data['morph level'])] = data['response mean']
+    return keys, curves
+
+
+def fit_cohort(store, by=('subject',), subjects=None, run=None, exclude_couples=False, maxfev=5000,
+               jac=None, n_jobs=1):
+    keys, curves = get_curves(store, by, subjects, run, exclude_couples)
+    result = fit_curves(curves, maxfev=maxfev, jac=jac, n_jobs=n_jobs)
+    result.update(keys)
+    result['curves'] = curves
+    result['morph_levels'] = result['popt'][:, 1]
+    return result
+
+
+def _bootstrap_chunk(args):
+    levels, responses, nb_samples, seed, xdata, p0, x0_range = args
+    rng = numpy.random.default_rng(seed)
+    curves = numpy.full((nb_samples, len(xdata)), numpy.nan)
+    for count, level in enumerate(numpy.unique(levels)):
+        values = responses[levels == level]
+        draws = rng.integers(0, len(values), size=(nb_samples, len(values)))
+        curves[:, count] = values[draws].mean(axis=1)
+    if numpy.all(numpy.isfinite(p0)):
+        p0 = numpy.tile(p0, (nb_samples, 1))
+    else:
+        p0 = None
+    popt = fit_batch(curves, xdata, p0=p0)[0]
+    if x0_range is not None:
+        # a threshold outside the tested morph levels is not identified by the resample
+        with numpy.errstate(invalid='ignore'):
+            popt[(popt[:, 1] < x0_range[0]) | (popt[:, 1] > x0_range[1])] = numpy.nan
+    return popt
+
+
+def bootstrap_cohort(store, subjects=None, run=None, exclude_couples=False, nb_samples=1000,
+                     alpha=0.05, seed=None, x0_range=(MORPH_LEVELS[0], MORPH_LEVELS[-1]), n_jobs=None):
+    excluded = False if exclude_couples else None
+    data = store.query(subjects, run=run, excluded=excluded, columns=['subject', 'morph level', 'response'])
+    all_subjects = numpy.unique(data['subject'])
+    seeds = numpy.random.SeedSequence(seed).spawn(len(all_subjects))
+    # every resample of a subject starts from the fit of its full curve
+    reference = fit_cohort(store, subjects=subjects, run=run, exclude_couples=exclude_couples, n_jobs=n_jobs)
+    reference = dict(zip(reference['subject'], reference['popt']))
+
+    tasks = []
+    for subject, subject_seed in zip(all_subjects, seeds):
+        mask = numpy.asarray(data['subject']) == subject
+        levels = numpy.asarray(data['morph level'])[mask]
+        responses = numpy.asarray(data['response'], dtype=numpy.float64)[mask]
+        tasks += [(levels, responses, nb_samples, subject_seed, MORPH_LEVELS, reference[subject], x0_range)]
+
+    if n_jobs == 1:
+        samples = list(map(_bootstrap_chunk, tasks))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(n_jobs) as executor:
+            samples = list(executor.map(_bootstrap_chunk, tasks))
+
+    samples = numpy.stack(samples)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        low, high = numpy.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=1)
+    return {'subject' : all_subjects, 'samples' : samples, 'low' : low, 'high' : high,
+            'success' : numpy.mean(~numpy.isnan(samples[..., 1]), axis=1)}
@@ -0,0 +1,106 @@
+import os
+import json
+import time
+import threading
+import subprocess
+import concurrent.futures
+import profiling
+
+
+class Journal(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = {}
+        if os.path.exists(self.filename):
+            with open(self.filename) as f:
+                self._data = json.load(f)
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, **values):
+        with self._lock:
+            self._data[key] = values
+            self.save()
+
+    def items(self):
+        return list(self._data.items())
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp_filename = self.filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(self._data, f, indent=2)
+        os.replace(tmp_filename, self.filename)
+
+
+class Job(object):
+
+    def __init__(self, name, command, is_complete=None, env=None):
+        self.name = name
+        self.command = command
+        self.is_complete = is_complete
+        self.env = env
+
+    def __repr__(self):
+        return 'Job(%s)' %self.name
+
+
+class Scheduler(object):
+
+    def __init__(self, log_path, concurrency=1):
+        self.log_path = log_path
+        self.concurrency = concurrency
+        if not os.path.exists(self.log_path):
+            os.makedirs(self.log_path)
+        self.journal = Journal(os.path.join(self.log_path, 'jobs.json'))
+
+    def _run_job(self, job):
+        log_file = os.path.join(self.log_path, '%s.log' %job.name)
+        env = None
+        if job.env is not None:
+            env = dict(os.environ, **job.env)
+        t_start = time.time()
+        self.journal.set(job.name, state='running', command=job.command, log=log_file, started=t_start)
+        with open(log_file, 'w') as log:
+            log.write(' '.join(job.command) + '\n')
+            log.flush()
+            try:
+                with profiling.span(os.path.basename(job.command[0]), job=job.name):
+                    returncode = subprocess.call(job.command, stdout=log, stderr=subprocess.STDOUT, env=env)
+            except OSError as error:
+                log.write(str(error) + '\n')
+                returncode = -1
+        state = 'done' if returncode == 0 else 'failed'
+        self.journal.set(job.name, state=state, command=job.command, log=log_file, started=t_start,
+                         returncode=returncode, duration=time.time() - t_start)
+        print(job.name, state, '(%.1fs)' %(time.time() - t_start))
+        return job.name, state
+
+    def _should_run(self, job, only_failed):
+        entry = self.journal.get(job.name, {})
+        if only_failed:
+            return entry.get('state') == 'failed'
+        # the outputs are authoritative when they can be checked, deleted outputs are generated again
+        if job.is_complete is not None:
+            return not job.is_complete()
+        return entry.get('state') != 'done'
+
+    def run(self, jobs, only_failed=False):
+        jobs = [job for job in jobs if self._should_run(job, only_failed)]
+        with concurrent.futures.ThreadPoolExecutor(max(1, self.concurrency)) as executor:
+            results = dict(executor.map(self._run_job, jobs))
+        return results
+
+    @property
+    def failed(self):
+        return [name for name, entry in self.journal.items() if entry.get('state') == 'failed']
+
+    @property
+    def summary(self):
+        return {name : {key : entry.get(key) for key in ['state', 'returncode', 'duration', 'log']}
+                for name, entry in self.journal.items()}
@@ -0,0 +1,106 @@
+import os
+import errno
+import fnmatch
+import hashlib
+import shutil
+import concurrent.futures
+
+IGNORE_PATTERNS = ['*.xlsx', '.DS_Store', 'Thumbs.db']
+BLOCK_SIZE = 1 << 22
+FICLONE = 0x40049409
+
+
+def checksum(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def _reflink(source, target):
+    import fcntl
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+
+
+def _copy(source, target):
+    md5 = hashlib.md5()
+    with open(source, 'rb') as src, open(target, 'wb') as dst:
+        for block in iter(lambda: src.read(BLOCK_SIZE), b''):
+            md5.update(block)
+            dst.write(block)
+        dst.flush()
+        os.fsync(dst.fileno())
+    shutil.copystat(source, target)
+    return md5.hexdigest()
+
+
+def copy_file(source, target, mode='link'):
+    # mode is one of 'link' (hardlink, then reflink, then copy), 'reflink' or 'copy'
+    tmp_target = target + '.part'
+    if os.path.exists(tmp_target):
+        os.remove(tmp_target)
+    same_device = os.stat(source).st_dev == os.stat(os.path.dirname(target)).st_dev
+
+    if mode == 'link' and same_device:
+        try:
+            os.link(source, tmp_target)
+            os.replace(tmp_target, target)
+            return checksum(target)
+        except OSError:
+            pass
+
+    source_checksum = None
+    if mode in ['link', 'reflink'] and same_device:
+        try:
+            _reflink(source, tmp_target)
+            shutil.copystat(source, tmp_target)
+        except (OSError, ImportError) as error:
+            if isinstance(error, OSError) and error.errno not in [errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                                                                  errno.EINVAL, errno.EPERM]:
+                raise
+            source_checksum = _copy(source, tmp_target)
+        else:
+            source_checksum = checksum(source)
+    else:
+        source_checksum = _copy(source, tmp_target)
+
+    target_checksum = checksum(tmp_target)
+    if target_checksum != source_checksum:
+        os.remove(tmp_target)
+        raise IOError('Checksum mismatch while copying %s' %source)
+    os.replace(tmp_target, target)
+    return target_checksum
+
+
+def list_files(path, ignore=IGNORE_PATTERNS):
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            if not any(fnmatch.fnmatch(name, pattern) for pattern in ignore):
+                files += [os.path.relpath(os.path.join(root, name), path)]
+    return files
+
+
+def copy_tree(source, target, ignore=IGNORE_PATTERNS, mode='link', n_threads=4):
+    files = list_files(source, ignore)
+    for directory in set(os.path.dirname(os.path.join(target, i)) for i in files) | {target}:
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    # largest files first so that the pool is not left waiting on one big REC file
+    files = sorted(files, key=lambda i: os.path.getsize(os.path.join(source, i)), reverse=True)
+
+    def copy(filename):
+        return filename, copy_file(os.path.join(source, filename), os.path.join(target, filename), mode)
+
+    if n_threads == 1:
+        return dict(map(copy, files))
+    with concurrent.futures.ThreadPoolExecutor(n_threads) as executor:
+        return dict(executor.map(copy, files))
+
+
+def verify(filename, expected):
+    return os.path.exists(filename) and checksum(filename) == expected